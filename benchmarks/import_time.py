@@ -0,0 +1,51 @@
+"""Measure the time and peak memory (RSS) taken to import polybot.
+
+Service SDKs are imported when a service is used. To compare against importing them all up
+front, as polybot previously did, the "eager" case imports them alongside polybot.
+
+    python benchmarks/import_time.py [runs]
+"""
+
+import statistics
+import subprocess
+import sys
+
+CASES = {
+    "startup": "pass",
+    "lazy": "import polybot",
+    "eager": "import polybot, httpx, atproto, atproto_client.exceptions, mastodon",
+}
+
+# Run in a separate process for each case, as the max RSS of child processes is the maximum
+# over all children which have been waited for.
+RUNNER = """
+import resource, subprocess, sys, time
+times = []
+for _ in range(int(sys.argv[2])):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", sys.argv[1]], check=True)
+    times.append(time.perf_counter() - start)
+print(" ".join(map(str, times)), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+"""
+
+
+def main():
+    runs = sys.argv[1] if len(sys.argv) > 1 else "10"
+    print(f"{'case':<8} {'median (ms)':>12} {'min (ms)':>10} {'max RSS (MB)':>13}")
+    for name, code in CASES.items():
+        out = subprocess.run(
+            [sys.executable, "-c", RUNNER, code, runs],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+        times = [float(t) for t in out[:-1]]
+        rss_mb = int(out[-1]) / 1024
+        print(
+            f"{name:<8} {statistics.median(times) * 1000:>12.0f} "
+            f"{min(times) * 1000:>10.0f} {rss_mb:>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Compare the number of encodes and wall time taken by Image.resize_to_target against the
+previous fixed-step algorithm, using the test image. Then compare the "speed" and "quality"
+resize policies on a large synthetic JPEG.
+
+    python benchmarks/resize.py
+"""
+
+import time
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image as PILImage
+from PIL import ImageFilter
+
+from polybot.image import Image
+
+SAMPLE = Path(__file__).parent.parent / "tests" / "images" / "sample.png"
+TARGETS = [
+    (1500000, None),
+    (1000000, None),
+    (500000, None),
+    (200000, None),
+    (5000000, 1000 * 1000),
+]
+
+encodes = 0
+_save = PILImage.Image.save
+
+
+def counting_save(self, *args, **kwargs):
+    global encodes
+    encodes += 1
+    return _save(self, *args, **kwargs)
+
+
+PILImage.Image.save = counting_save  # type: ignore
+
+
+def legacy_resize(image, target_bytes, target_pixels=None):
+    """The previous fixed-step algorithm used by resize_to_target."""
+    original_bytes = len(image.data)
+    img = PILImage.open(BytesIO(image.data))
+    margin = 0.9
+    new_bytes = original_bytes
+    new_pixels = original_pixels = img.size[0] * img.size[1]
+    output_bytes = image.data
+
+    if target_pixels is None:
+        target_pixels = original_pixels
+
+    while new_bytes > target_bytes or new_pixels > target_pixels:
+        new_pixels = min(
+            int(original_pixels * (target_bytes * margin / original_bytes)),
+            target_pixels,
+        )
+        ratio = (new_pixels / original_pixels) ** 0.5
+        new_size = (int(img.width * ratio), int(img.height * ratio))
+        output_buf = BytesIO()
+        img.resize(new_size).save(output_buf, format=img.format)
+        output_bytes = output_buf.getvalue()
+        new_bytes = len(output_bytes)
+        margin -= 0.05
+    return output_bytes
+
+
+def new_resize(image, target_bytes, target_pixels=None):
+    # Call the uncached implementation directly
+    return image._resize(target_bytes, target_pixels, None).data
+
+
+def main():
+    image = Image(path=SAMPLE, mime_type="image/png")
+    print(f"{SAMPLE.name}: {len(image.data) // 1024} kB, {image.pixels} pixels\n")
+    print(
+        f"{'target':>22}  {'algorithm':<8} {'encodes':>7} {'time (s)':>9} "
+        f"{'output kB':>9} {'of target':>9}"
+    )
+    for target_bytes, target_pixels in TARGETS:
+        label = f"{target_bytes // 1000} kB" + (
+            f", {target_pixels} px" if target_pixels else ""
+        )
+        for name, func in (("legacy", legacy_resize), ("new", new_resize)):
+            global encodes
+            encodes = 0
+            start = time.perf_counter()
+            output = func(image, target_bytes, target_pixels)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{label:>22}  {name:<8} {encodes:>7} {elapsed:>9.2f} "
+                f"{len(output) // 1024:>9} {len(output) / target_bytes:>9.0%}"
+            )
+
+    print("\nGenerating 6000x4000 JPEG...")
+    bands = [
+        PILImage.effect_noise((6000, 4000), 40).filter(ImageFilter.GaussianBlur(1.5))
+        for _ in range(3)
+    ]
+    buf = BytesIO()
+    PILImage.merge("RGB", bands).save(buf, format="JPEG", quality=92)
+    print(f"{len(buf.getvalue()) // 1024} kB\n")
+    print(f"{'target':>22}  {'policy':<8} {'encodes':>7} {'time (s)':>9} {'pixels':>9}")
+    for target_bytes in (1000000, 300000, 100000):
+        for policy in ("quality", "speed"):
+            image = Image(data=buf.getvalue(), resize_policy=policy)
+            encodes = 0
+            start = time.perf_counter()
+            output = image._resize(target_bytes, None, None)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{target_bytes // 1000:>19} kB  {policy:<8} {encodes:>7} "
+                f"{elapsed:>9.2f} {output.pixels:>9}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compare the time taken to save and load a large bot state, and the size of the state
+file, with each state codec. Codecs whose dependencies aren't installed are skipped.
+
+    python benchmarks/state_codecs.py [items]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from polybot.state import STATE_COMPRESSIONS, STATE_FORMATS, PickleBackend, StateCodec
+
+RUNS = 5
+
+
+def make_state(items):
+    """A state like a typical bot's: the IDs and URLs of items already posted, details of
+    recent items, and some counters."""
+    rng = random.Random(1)
+    return {
+        "last_run": 1700000000.5,
+        "posted_ids": [rng.getrandbits(60) for _ in range(items)],
+        "posted_urls": [
+            f"https://example.com/items/{rng.getrandbits(40):x}" for _ in range(items)
+        ],
+        "recent": {
+            str(i): {
+                "title": f"Item {i} " + "x" * rng.randint(20, 120),
+                "score": rng.random(),
+                "tags": [f"tag{rng.randint(0, 50)}" for _ in range(3)],
+            }
+            for i in range(items // 10)
+        },
+        "counts": {f"source{i}": rng.randint(0, 10000) for i in range(100)},
+    }
+
+
+def codecs():
+    for format in STATE_FORMATS:
+        yield format
+        for compression in STATE_COMPRESSIONS:
+            yield f"{format}+{compression}"
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    state = make_state(items)
+    print(f"{items} items\n")
+    print(f"{'codec':<16} {'save (ms)':>9} {'load (ms)':>9} {'size (kB)':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.state")
+        for name in codecs():
+            backend = PickleBackend(path, StateCodec(name))
+            try:
+                backend.save(state)
+            except ImportError as e:
+                print(f"{name:<16} skipped ({e.name} not installed)")
+                continue
+
+            start = time.perf_counter()
+            for _ in range(RUNS):
+                backend.save(state)
+            save_time = (time.perf_counter() - start) / RUNS
+
+            start = time.perf_counter()
+            for _ in range(RUNS):
+                loaded = backend.load()
+            load_time = (time.perf_counter() - start) / RUNS
+            assert loaded == state
+
+            print(
+                f"{name:<16} {save_time * 1000:>9.1f} {load_time * 1000:>9.1f} "
+                f"{os.path.getsize(path) // 1024:>9}"
+            )
+
+
+if __name__ == "__main__":
+    main()
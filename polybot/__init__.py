@@ -1,4 +1,4 @@
-from .bot import Bot
+from .bot import AsyncBot, Bot
 from .image import Image
 
-__all__ = ["Bot", "Image"]
+__all__ = ["AsyncBot", "Bot", "Image"]
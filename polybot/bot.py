@@ -1,17 +1,66 @@
 import argparse
+import asyncio
 import configparser
 import logging
-import pickle
 import signal
 import sys
+import threading
+import uuid
+from collections.abc import Awaitable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
 from typing import Any, Optional, Union
 
-from .image import Image
+from .image import Image, resize_cache
+from .outbox import Outbox
+from .seen import SeenSet
 from .service import ALL_SERVICES, PostError, Service
+from .state import (
+    STATE_BACKENDS,
+    StateBackend,
+    StateCodec,
+    StateDict,
+    StateWriter,
+)
 
 
 class Bot:
     path = ""
+    # Maximum number of services to post to concurrently. None means one worker per service,
+    # 1 posts to each service in turn.
+    post_workers: Optional[int] = None
+    # Seconds to wait for all services to finish posting before giving up on the slow ones.
+    post_timeout: Optional[float] = None
+    # Whether to keep resized images in a cache directory next to the state file, so that
+    # images which are posted repeatedly only need to be resized once.
+    image_cache = False
+    # Seconds to wait at startup for services to authenticate. Services which fail, or which
+    # are still authenticating after this, are retried in the background and posted to once
+    # they're ready.
+    auth_timeout: Optional[float] = 30
+    # Seconds to wait before retrying a failed service. This doubles after each failure, up
+    # to auth_retry_max.
+    auth_retry_delay = 30.0
+    auth_retry_max = 1800.0
+    # Whether to queue posts on disk and deliver them in the background, retrying failures.
+    # When this is enabled, post() returns a Future for each service instead of its result.
+    post_queue = False
+    # How to store the bot's state. "pickle" rewrites the whole state file each time it's
+    # saved, while "sqlite" only writes the keys which have changed, which is much faster for
+    # large states. The state must be a dict with string keys to use "sqlite".
+    state_backend = "pickle"
+    # How to serialise the state: "pickle", "json" or "msgpack", optionally compressed with
+    # "+gzip", "+lzma" or "+zstd", such as "pickle+zstd". Existing state can be loaded after
+    # switching from pickle.
+    state_codec = "pickle"
+    # Save the state in a background thread every autosave_interval seconds, and/or after
+    # autosave_changes changes to it (with the sqlite backend only). None disables each.
+    # Except in AsyncBot, the state is serialised on that thread while the bot may be
+    # changing it, so an autosave may catch it part way through a change.
+    autosave_interval: Optional[float] = None
+    autosave_changes: Optional[int] = None
+    # Seconds after which items added to self.seen are forgotten. None keeps them forever.
+    seen_ttl: Optional[float] = None
 
     def __init__(self, name: str) -> None:
         logging.basicConfig(
@@ -43,9 +92,49 @@ class Bot:
 
         self.name = name
         self.services: list[Service] = []
+        # Services which haven't authenticated yet, keyed by name
+        self.degraded: dict[str, Service] = {}
         self.state: Any = {}
+        self.state_store: Optional[StateBackend] = None
+        self.state_writer: Optional[StateWriter] = None
+        self._state_lock = threading.RLock()
+        # Compact set of items which have already been posted about, saved with the state
+        self.seen = SeenSet(self.seen_ttl)
+        self._post_executor: Optional[ThreadPoolExecutor] = None
+        self.outbox: Optional[Outbox] = None
+        self._services_lock = threading.Lock()
 
     def run(self) -> None:
+        if not self.start():
+            return
+
+        self.connect_services()
+        if not self.check_services():
+            return
+
+        signal.signal(signal.SIGTERM, self.signal)
+        signal.signal(signal.SIGINT, self.signal)
+        signal.signal(signal.SIGHUP, lambda _signum, _frame: self.request_save())
+
+        self.load_state()
+        self.start_autosave()
+        self.open_outbox()
+        self.log.info("Running")
+        try:
+            self.main()
+        finally:
+            self.stop_autosave()
+            if self._post_executor is not None:
+                self._post_executor.shutdown(wait=False)
+            if self.outbox is not None:
+                self.outbox.close()
+            self.save_state()
+            self.get_state_store().close()
+            self.log.info("Shut down")
+
+    def start(self) -> bool:
+        """Parse arguments and read config. Returns False if the bot shouldn't continue
+        to run."""
         self.args = self.parser.parse_args()
         logging.getLogger("root").setLevel(self.args.loglevel)
         self.log.info("Polybot starting...")
@@ -53,9 +142,11 @@ class Bot:
         profile = ""
         if len(self.args.profile):
             profile = "-" + self.args.profile
-        prefix = f"{self.path}{self.name}{profile}"
+        prefix = self.prefix = f"{self.path}{self.name}{profile}"
         self.config_path = prefix + ".conf"
         self.state_path = prefix + ".state"
+        if self.image_cache:
+            resize_cache.path = prefix + ".imagecache"
         self.read_config()
 
         if self.args.setup:
@@ -63,35 +154,115 @@ class Bot:
                 self.setup()
             except KeyboardInterrupt:
                 pass
-            return
+            return False
 
         if not self.args.live:
             self.log.warning(
                 "Running in test mode - not posting updates. Pass --live to run in live mode."
             )
+        return True
 
-        for Svc in ALL_SERVICES:
-            if Svc.name in self.config:
-                svc = Svc(self.config, self.args.live)
-                svc.auth()
+    def configured_services(self) -> list[type[Service]]:
+        return [Svc for Svc in ALL_SERVICES if Svc.name in self.config]
+
+    def create_service(self, Svc: type[Service]) -> Service:
+        return Svc(
+            self.config, self.args.live, cache_path=f"{self.prefix}.{Svc.name}.cache"
+        )
+
+    def connect_services(self) -> None:
+        """Authenticate all configured services concurrently, waiting up to `auth_timeout`
+        seconds. Services which aren't ready by then are left in `self.degraded` and
+        retried in the background."""
+        services = [self.create_service(Svc) for Svc in self.configured_services()]
+        if not services:
+            return
+
+        executor = ThreadPoolExecutor(
+            max_workers=len(services), thread_name_prefix="polybot-auth"
+        )
+        futures = {executor.submit(svc.auth): svc for svc in services}
+        done, _ = wait(futures, timeout=self.auth_timeout)
+        executor.shutdown(wait=False)
+
+        for future, svc in futures.items():
+            if future in done and future.exception() is None:
                 self.services.append(svc)
+                continue
+            if future not in done:
+                self.log.warning(
+                    "%s still authenticating after %ss, continuing without it",
+                    svc.name,
+                    self.auth_timeout,
+                )
+            self.degraded[svc.name] = svc
+            future.add_done_callback(partial(self._auth_done, svc))
 
-        if len(self.services) == 0:
-            self.log.warning("No services to post to. Use --setup to configure some!")
-            if self.args.live:
-                return
+    def _auth_done(self, svc: Service, future: Future) -> None:
+        exc = future.exception()
+        if exc is None:
+            self._service_ready(svc)
+            return
+        self.log.error(
+            "Error authenticating to %s, retrying in %ss",
+            svc.name,
+            self.auth_retry_delay,
+            exc_info=exc,
+        )
+        self._schedule_auth(svc, self.auth_retry_delay)
 
-        signal.signal(signal.SIGTERM, self.signal)
-        signal.signal(signal.SIGINT, self.signal)
-        signal.signal(signal.SIGHUP, lambda _signum, _frame: self.save_state())
+    def _schedule_auth(self, svc: Service, delay: float) -> None:
+        timer = threading.Timer(delay, self._retry_auth, (svc, delay))
+        timer.daemon = True
+        timer.start()
 
-        self.load_state()
-        self.log.info("Running")
+    def _retry_auth(self, svc: Service, delay: float) -> None:
         try:
-            self.main()
-        finally:
-            self.save_state()
-            self.log.info("Shut down")
+            svc.auth()
+        except Exception:
+            delay = min(delay * 2, self.auth_retry_max)
+            self.log.exception(
+                "Error authenticating to %s, retrying in %ss", svc.name, delay
+            )
+            self._schedule_auth(svc, delay)
+        else:
+            self._service_ready(svc)
+
+    def _service_ready(self, svc: Service) -> None:
+        with self._services_lock:
+            self.degraded.pop(svc.name, None)
+            # Replace rather than append, so posts in progress keep a consistent list
+            self.services = self.services + [svc]
+            if self.outbox is not None:
+                self.outbox.start(svc.name)
+        self.log.info("%s is now connected", svc.name)
+
+    def open_outbox(self) -> None:
+        """Open the queue of posts waiting to be delivered, if `post_queue` is enabled, and
+        start delivering to the services which are connected."""
+        if not self.post_queue:
+            return
+        with self._services_lock:
+            self.outbox = Outbox(self.prefix + ".queue", self.deliver)
+            for svc in self.services:
+                self.outbox.start(svc.name)
+        pending = self.outbox.pending()
+        if pending:
+            self.log.info("%s queued posts waiting to be delivered", pending)
+
+    def deliver(self, name: str, payload: tuple):
+        """Deliver a queued post to a service."""
+        for service in self.services:
+            if service.name == name:
+                return service.post(*payload)
+        raise PostError(f"Service {name} is not connected", transient=True)
+
+    def check_services(self) -> bool:
+        if len(self.services) == 0 and not self.degraded:
+            self.log.warning("No services to post to. Use --setup to configure some!")
+            if self.args.live:
+                return False
+        return True
 
     def signal(self, signum, _frame) -> None:
         self.save_state()
@@ -122,19 +293,84 @@ class Bot:
     def main(self) -> None:
         raise NotImplementedError()
 
+    def get_state_store(self) -> StateBackend:
+        if self.state_store is None:
+            self.state_store = STATE_BACKENDS[self.state_backend](
+                self.state_path, StateCodec(self.state_codec)
+            )
+        return self.state_store
+
     def load_state(self) -> None:
         try:
-            with open(self.state_path, "rb") as f:
-                self.state = pickle.load(f)
+            self.state = self.get_state_store().load()
         except OSError:
             self.log.info("No state file found")
+        try:
+            self.seen = SeenSet.load(self.state_path + ".seen", self.seen_ttl)
+        except FileNotFoundError:
+            pass
 
     def save_state(self) -> None:
         """Save the bot's state to disk."""
-        if len(self.state) != 0:
-            self.log.info("Saving state...")
-            with open(self.state_path, "wb") as f:
-                pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+        snapshot = self.snapshot_state()
+        if self.state_writer is not None:
+            # Write it after any snapshot which the writer hasn't written yet
+            self.state_writer.flush(snapshot)
+        else:
+            self.write_state(snapshot)
+
+    def snapshot_state(self) -> Any:
+        """Serialise the state, to be written by `write_state`. This must be called on the
+        thread which changes the state, so that the snapshot is consistent."""
+        with self._state_lock:
+            return self.get_state_store().snapshot(self.state)
+
+    def background_snapshot_state(self) -> Any:
+        """Serialise the state for an autosave, on the writer thread. The bot may be
+        changing the state meanwhile, so the snapshot may not be consistent."""
+        return self.snapshot_state()
+
+    def write_state(self, snapshot: Any) -> None:
+        """Write a snapshot of the state, and `self.seen` if it has changed."""
+        self.log.info("Saving state...")
+        self.get_state_store().write(snapshot)
+        if self.seen.changed:
+            self.seen.expire()
+            self.seen.save(self.state_path + ".seen")
+
+    def request_save(self) -> None:
+        """Save the state in the background as soon as possible, without waiting for it to
+        be written. This is what SIGHUP does, so that a save doesn't hold up the bot. The
+        state is serialised straight away, so call this on the thread which changes it.
+        """
+        if self.state_writer is not None:
+            self.state_writer.request()
+        else:
+            self.save_state()
+
+    def start_autosave(self) -> None:
+        """Start the background state writer, which saves the state when requested, and
+        every `autosave_interval` seconds or `autosave_changes` changes, if set."""
+        if self.autosave_changes is not None and not isinstance(self.state, StateDict):
+            # Only StateDict counts changes, and only the sqlite backend uses it
+            self.log.warning(
+                'autosave_changes has no effect unless state_backend is "sqlite"'
+            )
+        self.state_writer = StateWriter(
+            self.snapshot_state,
+            self.write_state,
+            self.get_state_store().merge,
+            self.autosave_interval,
+            self.autosave_changes,
+            lambda: getattr(self.state, "mutations", 0),
+            self.background_snapshot_state,
+        )
+        self.state_writer.start()
+
+    def stop_autosave(self) -> None:
+        if self.state_writer is not None:
+            self.state_writer.stop()
+            self.state_writer = None
 
     def post(
         self,
@@ -147,8 +383,12 @@ class Bot:
     ) -> dict:
         """Publish a post to all configured services.
 
-        If a service fails to post, the error is logged and the post is still sent to the
-        remaining services.
+        Services are posted to concurrently (see `post_workers` and `post_timeout`). If a
+        service fails to post, or doesn't finish within `post_timeout` seconds, the error is
+        logged and the result from that service is omitted.
+
+        If `post_queue` is enabled, the post is queued for each service and this returns
+        immediately with a Future for each service's result.
 
         Arguments:
             status: The status text to post (required). It can be a list of strings, in which
@@ -159,6 +399,98 @@ class Bot:
             lat: Latitude to attach to the post. (Twitter only)
             lon: Longitude to attach to the post. (Twitter only)
         """
+        self.check_post(status, wrap, images)
+        if self.outbox is not None:
+            return self.queue_post(status, wrap, images, in_reply_to_id, lat, lon)
+
+        services = self.services
+        resized = self.resize_images(images, services)
+
+        if self.post_workers == 1 or len(services) <= 1:
+            out = {}
+            for service in services:
+                try:
+                    out[service.name] = self._post_to(
+                        service,
+                        status,
+                        wrap,
+                        resized[service.name],
+                        lat,
+                        lon,
+                        in_reply_to_id,
+                    )
+                except PostError:
+                    self.log.exception("Error posting to %s", service)
+            return out
+
+        if self._post_executor is None:
+            self._post_executor = ThreadPoolExecutor(
+                max_workers=self.post_workers or len(services),
+                thread_name_prefix="polybot-post",
+            )
+
+        futures = {
+            self._post_executor.submit(
+                self._post_to,
+                service,
+                status,
+                wrap,
+                resized[service.name],
+                lat,
+                lon,
+                in_reply_to_id,
+            ): service
+            for service in services
+        }
+        done, not_done = wait(futures, timeout=self.post_timeout)
+
+        out = {}
+        for future in done:
+            service = futures[future]
+            try:
+                out[service.name] = future.result()
+            except PostError:
+                self.log.exception("Error posting to %s", service)
+        for future in not_done:
+            self.log.error(
+                "Timed out after %ss posting to %s", self.post_timeout, futures[future]
+            )
+        return out
+
+    def queue_post(
+        self,
+        status: Union[str, list[str]],
+        wrap: bool,
+        images: list[Image],
+        in_reply_to_id,
+        lat: Optional[float],
+        lon: Optional[float],
+    ) -> dict:
+        """Queue a post for delivery to each service, including those which aren't
+        connected yet. Returns a dict of service names to Futures."""
+        assert self.outbox is not None
+        services = self.services + list(self.degraded.values())
+        resized = self.resize_images(images, services)
+        out = {}
+        for service in services:
+            reply_id = in_reply_to_id[service.name] if in_reply_to_id else None
+            # Images are stored in the queue, in case their files are removed before delivery
+            payload = (
+                status,
+                wrap,
+                [i.in_memory() for i in resized[service.name]],
+                lat,
+                lon,
+                reply_id,
+                # Kept with the post so that delivering it again doesn't post it twice
+                uuid.uuid4().hex,
+            )
+            out[service.name] = self.outbox.put(service.name, payload)
+        return out
+
+    def check_post(
+        self, status: Union[str, list[str]], wrap: bool, images: list[Image]
+    ) -> None:
         if isinstance(status, list):
             if wrap:
                 raise ValueError("Cannot mix wrap and status list")
@@ -173,19 +505,43 @@ class Bot:
         self.log.info("> %s", status)
         if images:
             self.log.info("Images: %s", images)
+        if self.degraded:
+            self.log.warning(
+                "Not posting to unavailable services: %s", ", ".join(self.degraded)
+            )
 
-        out = {}
-        for service in self.services:
-            try:
-                if in_reply_to_id:
-                    in_reply_to_id = in_reply_to_id[service.name]
-                out[service.name] = service.post(
-                    status, wrap, images, lat, lon, in_reply_to_id
-                )
-            except PostError:
-                self.log.exception("Error posting to %s", service)
+    def resize_images(
+        self, images: list[Image], services: Optional[list[Service]] = None
+    ) -> dict[str, list[Image]]:
+        """Resize images to fit the limits of each service. Each image is resized once for
+        each distinct set of limits, rather than once per service.
+
+        Returns a dict mapping service names to lists of images.
+        """
+        if services is None:
+            services = self.services
+        out: dict[str, list[Image]] = {service.name: [] for service in services}
+        for i, image in enumerate(images):
+            targets = [s for s in services if i < s.max_image_count]
+            variants = image.resize_for_limits(s.image_limit for s in targets)
+            for s in targets:
+                out[s.name].append(variants[s.image_limit])
         return out
 
+    def _post_to(
+        self,
+        service: Service,
+        status: Union[str, list[str]],
+        wrap: bool,
+        images: list[Image],
+        lat: Optional[float],
+        lon: Optional[float],
+        in_reply_to_id,
+    ):
+        if in_reply_to_id:
+            in_reply_to_id = in_reply_to_id[service.name]
+        return service.post(status, wrap, images, lat, lon, in_reply_to_id)
+
     def read_config(self) -> None:
         self.config = configparser.ConfigParser()
         self.config.read(self.config_path)
@@ -193,3 +549,164 @@ class Bot:
     def write_config(self) -> None:
         with open(self.config_path, "w") as fp:
             self.config.write(fp)
+
+
+class AsyncBot(Bot):
+    """A bot which runs in an asyncio event loop. Subclasses should implement `main` as a
+    coroutine, and await `post`."""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self._auth_tasks: set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def run(self) -> None:
+        if not self.start():
+            return
+        asyncio.run(self.run_async())
+
+    async def run_async(self) -> None:
+        await self.connect_services_async()
+        if not self.check_services():
+            return
+
+        main = asyncio.current_task()
+        assert main is not None
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, main.cancel)
+        loop.add_signal_handler(signal.SIGINT, main.cancel)
+        loop.add_signal_handler(signal.SIGHUP, self.request_save)
+
+        self._loop = loop
+        self.load_state()
+        self.start_autosave()
+        self.open_outbox()
+        self.log.info("Running")
+        try:
+            await self.main()
+        except asyncio.CancelledError:
+            self.log.info("Shut down on signal")
+        finally:
+            await asyncio.to_thread(self.stop_autosave)
+            if self.outbox is not None:
+                # Delivery workers may be waiting on the event loop
+                await asyncio.to_thread(self.outbox.close)
+            self.save_state()
+            self.get_state_store().close()
+            self.log.info("Shut down")
+
+    async def connect_services_async(self) -> None:
+        """Authenticate all configured services concurrently, waiting up to `auth_timeout`
+        seconds. Services which aren't ready by then are retried in a background task.
+        """
+        services = [self.create_service(Svc) for Svc in self.configured_services()]
+        if not services:
+            return
+
+        tasks = {asyncio.ensure_future(svc.auth_async()): svc for svc in services}
+        done, _ = await asyncio.wait(tasks, timeout=self.auth_timeout)
+
+        for task, svc in tasks.items():
+            if task in done and task.exception() is None:
+                self.services.append(svc)
+                continue
+            if task not in done:
+                self.log.warning(
+                    "%s still authenticating after %ss, continuing without it",
+                    svc.name,
+                    self.auth_timeout,
+                )
+            self.degraded[svc.name] = svc
+            retry = asyncio.create_task(self._retry_auth_async(svc, task))
+            # The event loop only keeps weak references to tasks
+            self._auth_tasks.add(retry)
+            retry.add_done_callback(self._auth_tasks.discard)
+
+    async def _retry_auth_async(self, svc: Service, attempt: Awaitable) -> None:
+        delay = self.auth_retry_delay
+        while True:
+            try:
+                await attempt
+            except Exception:
+                self.log.exception(
+                    "Error authenticating to %s, retrying in %ss", svc.name, delay
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.auth_retry_max)
+                attempt = svc.auth_async()
+            else:
+                self._service_ready(svc)
+                return
+
+    def background_snapshot_state(self) -> Any:
+        # Serialise the state on the event loop, between the bot's own steps
+        assert self._loop is not None
+        return asyncio.run_coroutine_threadsafe(
+            self._snapshot_state(), self._loop
+        ).result()
+
+    async def _snapshot_state(self) -> Any:
+        return self.snapshot_state()
+
+    def deliver(self, name: str, payload: tuple):
+        assert self._loop is not None
+        for service in self.services:
+            if service.name == name:
+                return asyncio.run_coroutine_threadsafe(
+                    service.post_async(*payload), self._loop
+                ).result()
+        raise PostError(f"Service {name} is not connected", transient=True)
+
+    async def main(self) -> None:  # type: ignore[override]
+        raise NotImplementedError()
+
+    async def post(  # type: ignore[override]
+        self,
+        status: Union[str, list[str]],
+        wrap: bool = False,
+        images: list[Image] = [],
+        in_reply_to_id=None,
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+    ) -> dict:
+        """Publish a post to all configured services. This takes the same arguments as
+        `Bot.post`."""
+        self.check_post(status, wrap, images)
+        if self.outbox is not None:
+            queued = await asyncio.to_thread(
+                self.queue_post, status, wrap, images, in_reply_to_id, lat, lon
+            )
+            return {name: asyncio.wrap_future(f) for name, f in queued.items()}
+
+        services = self.services
+        resized = await asyncio.to_thread(self.resize_images, images, services)
+
+        limit = asyncio.Semaphore(self.post_workers or len(services) or 1)
+
+        async def post_to(service: Service):
+            async with limit:
+                reply_id = in_reply_to_id[service.name] if in_reply_to_id else None
+                return await asyncio.wait_for(
+                    service.post_async(
+                        status, wrap, resized[service.name], lat, lon, reply_id
+                    ),
+                    self.post_timeout,
+                )
+
+        results = await asyncio.gather(
+            *(post_to(service) for service in services), return_exceptions=True
+        )
+
+        out = {}
+        for service, result in zip(services, results):
+            if isinstance(result, PostError):
+                self.log.error("Error posting to %s", service, exc_info=result)
+            elif isinstance(result, asyncio.TimeoutError):
+                self.log.error(
+                    "Timed out after %ss posting to %s", self.post_timeout, service
+                )
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                out[service.name] = result
+        return out
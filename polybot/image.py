@@ -1,4 +1,11 @@
+import hashlib
 import logging
+import math
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Collection, Iterable
 from io import BytesIO
 from pathlib import Path
 from typing import BinaryIO, Optional
@@ -7,6 +14,60 @@ from PIL import Image as PILImage
 
 log = logging.getLogger(__name__)
 
+# resize_to_target stops searching once the output is within this fraction of the target size
+RESIZE_TOLERANCE = 0.1
+# The maximum number of encodes resize_to_target will perform before settling for the largest
+# image found that fits
+RESIZE_MAX_ITERATIONS = 8
+
+RESIZE_POLICIES = ("speed", "quality")
+
+# A (max bytes, max pixels, accepted MIME types) limit, as accepted by resize_to_target
+ImageLimit = tuple[int, Optional[int], Optional[tuple[str, ...]]]
+
+# Formats which can be re-encoded without further loss of quality.
+LOSSLESS_FORMATS = {"PNG", "GIF", "BMP", "TIFF"}
+# Lossy formats which images can be converted to, in order of preference.
+LOSSY_FORMATS = ("WEBP", "JPEG")
+# Quality settings to try when re-encoding lossy images, before reducing their size.
+QUALITY_STEPS = (90, 80, 70)
+# Formats which Pillow reports under their own name, but which are really another format.
+# Many camera JPEGs contain extra images, and are read as MPO.
+FORMAT_ALIASES = {"MPO": "JPEG"}
+
+
+def format_mime_type(fmt: Optional[str]) -> Optional[str]:
+    """Return the MIME type of a PIL format name."""
+    if fmt is None:
+        return None
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    if fmt not in PILImage.MIME:
+        # Not all plugins are loaded by default
+        PILImage.init()
+    return PILImage.MIME.get(fmt)
+
+
+def convert_mode(
+    img: PILImage.Image, fmt: str, palette: bool = False
+) -> PILImage.Image:
+    """Convert an image to a mode which can be saved in the given format."""
+    if palette:
+        return img.convert("P", palette=PILImage.Palette.ADAPTIVE, colors=256)
+    if fmt == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        if img.mode in ("RGBA", "LA"):
+            # JPEG doesn't support transparency, so flatten onto a white background
+            background = PILImage.new("RGB", img.size, "white")
+            background.paste(img, mask=img.getchannel("A"))
+            return background
+        return img.convert("RGB")
+    if fmt == "WEBP" and img.mode not in ("RGB", "RGBA"):
+        return img.convert(
+            "RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB"
+        )
+    return img
+
 
 class Image:
     """Represents an image to be attached to a Polybot post."""
@@ -18,6 +79,8 @@ class Image:
         data: Optional[bytes] = None,
         mime_type: Optional[str] = None,
         description: Optional[str] = None,
+        resize_policy: str = "speed",
+        allow_lossy: bool = False,
     ):
         """
         Create a new Image object. Provide either a `path`, `file`, or `data`.
@@ -29,72 +92,568 @@ class Image:
             data: Image file data as bytes.
             mime_type: MIME type of the image.
             description: Description (alt text) of the image.
+            resize_policy: How to decode the image when it needs resizing. "speed" lets
+                the JPEG decoder downscale while decoding, and reduces the image by
+                integer factors before resampling. "quality" always decodes at full
+                resolution and resamples in one step.
+            allow_lossy: Whether a lossless image (e.g. PNG) may be converted to a lossy
+                format (WebP or JPEG) to fit within a service's size limit. This is much
+                more efficient for photos, but may introduce artifacts into diagrams.
         """
+        if resize_policy not in RESIZE_POLICIES:
+            raise ValueError(f"resize_policy must be one of {RESIZE_POLICIES}")
+
+        self.path: Optional[Path] = None
+        self._data: Optional[bytes] = None
         if path is not None:
-            with open(path, "rb") as f:
-                self.data = f.read()
+            # Images created from a path are read lazily, so bots can prepare many images
+            # without holding them all in memory.
+            self.path = Path(path)
         elif file is not None:
-            self.data = file.read()
+            self._data = file.read()
         elif data is not None:
-            self.data = data
+            self._data = data
         else:
             raise ValueError("Must supply path, file, or data")
 
         self.mime_type = mime_type
         self.description = description
+        self.resize_policy = resize_policy
+        self.allow_lossy = allow_lossy
+        self._format: Optional[str] = None
+        self._pixels: Optional[int] = None
+        self._digest: Optional[str] = None
+
+    @property
+    def data(self) -> bytes:
+        """The image file data. For images created from a path, this reads the file."""
+        if self._data is not None:
+            return self._data
+        assert self.path is not None
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def __len__(self) -> int:
+        """The size of the image file data in bytes."""
+        if self._data is not None:
+            return len(self._data)
+        assert self.path is not None
+        return os.stat(self.path).st_size
+
+    def open(self) -> BinaryIO:
+        """Open the image data as a binary file object, for streaming uploads. For images
+        created from a path this opens the file; otherwise the data isn't copied."""
+        if self._data is not None:
+            return BytesIO(self._data)
+        assert self.path is not None
+        return open(self.path, "rb")
+
+    def view(self) -> memoryview:
+        """Return a read-only view of the image data. For images created from a path, the
+        file is memory-mapped rather than read."""
+        if self._data is not None:
+            return memoryview(self._data)
+        assert self.path is not None
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            # The mapping stays open for as long as the view is referenced
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __buffer__(self, flags: int) -> memoryview:
+        return self.view()
+
+    def in_memory(self) -> "Image":
+        """Return this image with its data held in memory, reading the file if the image was
+        created from a path."""
+        if self._data is not None:
+            return self
+        return self._derive(self.data)
+
+    def _pil_open(self) -> PILImage.Image:
+        if self._data is not None:
+            return PILImage.open(BytesIO(self._data))
+        assert self.path is not None
+        return PILImage.open(self.path)
+
+    def _read_header(self) -> None:
+        # PIL only reads the image header until the pixel data is accessed
+        with self._pil_open() as img:
+            self._format = img.format
+            self._pixels = img.size[0] * img.size[1]
+
+    @property
+    def format(self) -> Optional[str]:
+        """The PIL format name of the image (e.g. "PNG")."""
+        if self._pixels is None:
+            self._read_header()
+        return self._format
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 hex digest of the image data."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.view()).hexdigest()
+        return self._digest
+
+    @property
+    def pixels(self) -> int:
+        """The number of pixels in the image."""
+        if self._pixels is None:
+            self._read_header()
+        assert self._pixels is not None
+        return self._pixels
+
+    def fits(
+        self,
+        target_bytes: int,
+        target_pixels: Optional[int] = None,
+        mime_types: Optional[Collection[str]] = None,
+    ) -> bool:
+        """Whether the image is within a maximum size in bytes and (optionally) pixels, and
+        (optionally) is one of a list of MIME types.
+
+        Images which Pillow can't read (such as HEIC) can't be resized or converted, so only
+        their size in bytes is checked."""
+        if len(self) > target_bytes:
+            return False
+        if mime_types is None and target_pixels is None:
+            return True
+        try:
+            fmt, pixels = self.format, self.pixels
+        except PILImage.UnidentifiedImageError:
+            if mime_types is not None and self.mime_type not in mime_types:
+                log.warning("Unable to read %s image to convert it", self.mime_type)
+            return True
+        if mime_types is not None and format_mime_type(fmt) not in mime_types:
+            return False
+        return target_pixels is None or pixels <= target_pixels
 
     def resize_to_target(
-        self, target_bytes: int, target_pixels: Optional[int] = None
+        self,
+        target_bytes: int,
+        target_pixels: Optional[int] = None,
+        mime_types: Optional[Iterable[str]] = None,
     ) -> "Image":
         """Resize the image to a target maximum size in bytes and (optionally) pixels.
-        Returns a new Image object.
-        """
+        If `mime_types` is provided, the image will be converted to one of those types.
+        Returns a new Image object, or this one if it's already within the limits.
 
-        original_bytes = len(self.data)
-        if target_pixels is None and original_bytes < target_bytes:
+        Before reducing the size of the image, cheaper ways of reducing the file size are
+        tried: lossless PNG optimisation, then lower JPEG/WebP quality settings. Lossless
+        images are only converted to JPEG or WebP if `allow_lossy` is set, or if the
+        original format isn't acceptable.
+        """
+        types = None if mime_types is None else tuple(sorted(mime_types))
+        if self.fits(target_bytes, target_pixels, types):
             return self
 
-        img = PILImage.open(BytesIO(self.data))
-        margin = 0.9
-        new_bytes = original_bytes
-        new_pixels = original_pixels = img.size[0] * img.size[1]
-        output_bytes = self.data
+        key = resize_cache.key(self, target_bytes, target_pixels, types)
+        data = resize_cache.get(key)
+        if data is not None:
+            cached = self._derive(data)
+            # The cached image may have been converted to another format
+            if cached.format != self.format:
+                cached.mime_type = format_mime_type(cached.format)
+            return cached
+
+        resized = self._resize(target_bytes, target_pixels, types)
+        resize_cache.put(key, resized.data)
+        return resized
+
+    def _encodings(
+        self, img: PILImage.Image, mime_types: Optional[tuple[str, ...]]
+    ) -> list[tuple[str, dict]]:
+        """Return the (format, save options) to try when re-encoding the image, in order of
+        preference. The "palette" option converts the image to a palette image first, which
+        is only lossless if it has at most 256 colours, so `_resize` checks that before
+        trying it."""
 
-        if target_pixels is None:
-            target_pixels = original_pixels
+        def accepted(fmt: Optional[str]) -> bool:
+            return mime_types is None or format_mime_type(fmt) in mime_types
 
-        while new_bytes > target_bytes or new_pixels > target_pixels:
-            new_pixels = min(
-                int(original_pixels * (target_bytes * margin / original_bytes)),
-                target_pixels,
+        source = FORMAT_ALIASES.get(img.format or "", img.format)
+        encodings: list[tuple[str, dict]] = []
+        lossless = source in LOSSLESS_FORMATS
+        if lossless and (accepted(source) or accepted("PNG")):
+            fmt = source if source and accepted(source) else "PNG"
+            if fmt == "PNG":
+                encodings.append(("PNG", {"optimize": True}))
+                if img.mode in ("RGB", "L"):
+                    encodings.append(("PNG", {"optimize": True, "palette": True}))
+            else:
+                encodings.append((fmt, {}))
+        elif not lossless and accepted(source) and source in LOSSY_FORMATS:
+            encodings += [(source, {"quality": q}) for q in QUALITY_STEPS]
+
+        if not encodings or (lossless and self.allow_lossy):
+            for fmt in LOSSY_FORMATS:
+                if accepted(fmt) and fmt != source:
+                    encodings += [(fmt, {"quality": q}) for q in QUALITY_STEPS]
+                    break
+
+        if not encodings:
+            raise ValueError(
+                f"Unable to convert {img.format} image to any of {mime_types}"
             )
+        return encodings
+
+    def _resize(
+        self,
+        target_bytes: int,
+        target_pixels: Optional[int],
+        mime_types: Optional[tuple[str, ...]],
+    ) -> "Image":
+        """Re-encode the image, and find the largest scale factor at which it fits within
+        the limits.
+
+        Each candidate encoding is first tried at the largest scale allowed by
+        `target_pixels`, unless the size of the original image or a previous encode shows
+        that it's unlikely to fit. If none fit, the scale is reduced using the last
+        (smallest) encoding. The output size is assumed to be proportional to the pixel
+        count, starting with the bytes per pixel of the last encode (or of the original
+        image). After each
+        encode the scale is re-estimated from the measured size, falling back to bisection
+        between the largest scale known to fit and the smallest known not to, until the
+        output is within `RESIZE_TOLERANCE` of `target_bytes`.
+        """
+        original_bytes = len(self)
+        img = self._pil_open()
+        original_pixels = img.size[0] * img.size[1]
+        source_format = FORMAT_ALIASES.get(img.format or "", img.format)
+
+        max_scale = 1.0
+        if target_pixels is not None:
+            max_scale = min(max_scale, (target_pixels / original_pixels) ** 0.5)
+
+        speed = self.resize_policy == "speed"
+        decoded: Optional[PILImage.Image] = None
+        reduced: dict[int, PILImage.Image] = {}
+
+        def source(scale: float) -> PILImage.Image:
+            """Return a decoded image to resample from to reach `scale`."""
+            nonlocal decoded
+            target_width = int(img.width * scale)
+            if decoded is None or decoded.width < target_width:
+                bound = max_scale
+                if decoded is None:
+                    # Leave headroom in case the search needs a larger scale than the
+                    # first estimate. If it's not enough we decode again.
+                    bound = min(max_scale, scale * 2)
+                decoded = self._pil_open()
+                if speed and source_format == "JPEG":
+                    # Let the JPEG decoder scale down in the DCT domain
+                    decoded.draft(
+                        decoded.mode,
+                        (math.ceil(img.width * bound), math.ceil(img.height * bound)),
+                    )
+                decoded.load()
+                reduced.clear()
 
-            ratio = (new_pixels / original_pixels) ** 0.5
-            new_size = (int(img.width * ratio), int(img.height * ratio))
+            if not speed:
+                return decoded
+            # Reduce by an integer factor (cheap box filter) while leaving at least a
+            # factor of 2 for the final resample, which keeps the quality close to
+            # resampling the whole image.
+            factor = int(decoded.width / max(target_width, 1) / 2)
+            if factor < 2:
+                return decoded
+            if factor not in reduced:
+                reduced[factor] = decoded.reduce(factor)
+            return reduced[factor]
 
-            new_img = img.resize(new_size)
+        def encode(
+            scale: float, encoding: tuple[str, dict]
+        ) -> tuple[bytes, tuple[int, int]]:
+            fmt, options = encoding
+            new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+            new_img = source(scale)
+            if new_img.size != new_size:
+                new_img = new_img.resize(new_size)
+            new_img = convert_mode(new_img, fmt, options.get("palette", False))
 
             output_buf = BytesIO()
-            new_img.save(output_buf, format=img.format)
+            options = {k: v for k, v in options.items() if k != "palette"}
+            new_img.save(output_buf, format=fmt, **options)
             output_bytes = output_buf.getvalue()
-            new_bytes = len(output_bytes)
             log.debug(
-                (
-                    "Image is too large %s (%d kB). Resizing image to %d%% %s to remain within "
-                    "image size limit of %d kB. New size: %d kB"
-                ),
+                "Encoded image %s (%d kB) as %s %s at %d%% %s, new size: %d kB (limit %d kB)",
                 img.size,
                 original_bytes // 1024,
-                ratio * 100,
+                fmt,
+                options,
+                scale * 100,
                 new_size,
+                len(output_bytes) // 1024,
                 target_bytes // 1024,
-                new_bytes // 1024,
             )
-            margin -= 0.05
+            return output_bytes, new_size
 
+        def result(output_bytes: bytes, fmt: str, new_size: tuple[int, int]) -> Image:
+            resized = self._derive(output_bytes)
+            resized._format = fmt
+            resized._pixels = new_size[0] * new_size[1]
+            if fmt != img.format:
+                resized.mime_type = format_mime_type(fmt)
+            return resized
+
+        def few_colours() -> bool:
+            """Whether the image has few enough colours to convert it to a palette image
+            losslessly. This reuses the decoded image, which isn't reduced for PNGs."""
+            source(max_scale)
+            assert decoded is not None
+            return decoded.getcolors(256) is not None
+
+        encodings = self._encodings(img, mime_types)
+
+        # Try each encoding at full size first, skipping those which are unlikely to
+        # bring the size down enough, based on the last encode or the original image.
+        measured: Optional[tuple[str, int]] = None
+        i = 0
+        while i < len(encodings):
+            fmt, options = encodings[i]
+            if options.get("palette") and not few_colours():
+                del encodings[i]
+                continue
+            if measured is not None and measured[0] == fmt:
+                estimate: Optional[int] = measured[1]
+            elif fmt == source_format:
+                estimate = original_bytes
+            else:
+                estimate = None
+
+            if estimate is not None and not options.get("palette"):
+                # PNG optimisation only saves a few percent, and the range of quality
+                # steps can reduce the size by about half.
+                factor = 2 if "quality" in options else 1.25
+                if estimate > target_bytes * factor:
+                    i += 1
+                    continue
+
+            output_bytes, new_size = encode(max_scale, encodings[i])
+            if len(output_bytes) <= target_bytes:
+                return result(output_bytes, fmt, new_size)
+            measured = (fmt, len(output_bytes))
+            if "quality" in options and measured[1] > target_bytes * 1.5:
+                # Too far off for the next quality step to help - skip to the last one
+                while (
+                    i + 2 < len(encodings)
+                    and encodings[i + 2][0] == fmt
+                    and "quality" in encodings[i + 2][1]
+                ):
+                    i += 1
+            i += 1
+
+        fmt, options = encodings[-1]
+        search_encoding = (fmt, {k: v for k, v in options.items() if k != "optimize"})
+
+        # Aim for the middle of the tolerance band
+        aim = target_bytes * (1 - RESIZE_TOLERANCE / 2)
+
+        lo, hi = 0.0, max_scale
+        hi_tested = False
+        if measured is not None and measured[0] == fmt:
+            hi_tested = True
+            scale = max_scale * (aim / measured[1]) ** 0.5
+        elif fmt == source_format:
+            # The original image gives us a first estimate of bytes per pixel
+            scale = min(max_scale, (aim / original_bytes) ** 0.5)
+        else:
+            scale = max_scale
+        best = None
+        for _ in range(RESIZE_MAX_ITERATIONS):
+            output_bytes, new_size = encode(scale, search_encoding)
+            hi_tested = hi_tested or scale == hi
+            if len(output_bytes) <= target_bytes:
+                lo = scale
+                best = (output_bytes, new_size)
+                if scale == max_scale or len(output_bytes) >= target_bytes * (
+                    1 - RESIZE_TOLERANCE
+                ):
+                    break
+            else:
+                hi = scale
+                hi_tested = True
+            if best is not None and (hi - lo) * max(img.size) < 1:
+                break
+
+            # Re-estimate from this encode, falling back to bisection if the estimate
+            # falls outside the range we know contains the answer
+            scale = scale * (aim / len(output_bytes)) ** 0.5
+            if scale >= hi:
+                scale = hi if not hi_tested else (lo + hi) / 2
+            elif scale <= lo:
+                scale = (lo + hi) / 2
+
+        while best is None:
+            # Bytes are very far from proportional to pixels - keep halving
+            scale = hi = hi / 2
+            output_bytes, new_size = encode(scale, search_encoding)
+            if len(output_bytes) <= target_bytes or min(new_size) <= 1:
+                best = (output_bytes, new_size)
+
+        output_bytes, new_size = best
+        return result(output_bytes, fmt, new_size)
+
+    def _derive(self, data: bytes) -> "Image":
+        """Create a new Image with the given data and this image's attributes."""
         return Image(
-            data=output_bytes, mime_type=self.mime_type, description=self.description
+            data=data,
+            mime_type=self.mime_type,
+            description=self.description,
+            resize_policy=self.resize_policy,
+            allow_lossy=self.allow_lossy,
         )
 
+    def resize_for_limits(
+        self, limits: Iterable["ImageLimit"]
+    ) -> dict["ImageLimit", "Image"]:
+        """Resize the image to fit each of a set of (bytes, pixels, MIME types) limits, as
+        accepted by `resize_to_target`. Returns a dict mapping each limit to an Image.
+
+        Limits are processed from largest to smallest. An image resized for a larger limit
+        is reused for a smaller one if it happens to satisfy it, and lossless images are
+        resized from the previous (already reduced) output, which is cheaper to decode.
+        """
+
+        def key(limit: ImageLimit) -> tuple[int, float]:
+            return (limit[0], limit[1] or float("inf"))
+
+        def dominates(a: ImageLimit, b: ImageLimit) -> bool:
+            return all(x >= y for x, y in zip(key(a), key(b)))
+
+        out: dict[ImageLimit, Image] = {}
+        for limit in sorted(set(limits), key=key, reverse=True):
+            if self.fits(*limit):
+                out[limit] = self
+                continue
+
+            larger = [(lim, img) for lim, img in out.items() if dominates(lim, limit)]
+            for _, variant in larger:
+                if variant.fits(*limit):
+                    out[limit] = variant
+                    break
+            else:
+                source = self
+                if larger and larger[-1][1].format in LOSSLESS_FORMATS:
+                    source = larger[-1][1]
+                out[limit] = source.resize_to_target(*limit)
+        return out
+
     def __repr__(self):
         return f'Image({self.mime_type}, "{self.description}")'
+
+
+class ResizeCache:
+    """An LRU cache of resized image data, keyed on a hash of the original image data and
+    the target size.
+
+    Entries are held in memory up to `max_bytes`. If `path` is set, entries are also
+    written to that directory (up to `max_disk_entries` files), so that they persist
+    across runs.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        path: Optional[str | Path] = None,
+        max_disk_entries: int = 256,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def key(
+        self,
+        image: Image,
+        target_bytes: int,
+        target_pixels: Optional[int],
+        mime_types: Optional[tuple[str, ...]] = None,
+    ) -> str:
+        params = (
+            f"{image.format}-{image.resize_policy}-{image.allow_lossy}-"
+            f"{target_bytes}-{target_pixels}-{mime_types}"
+        )
+        # Hash the parameters to keep the key usable as a filename
+        return f"{image.digest}-{hashlib.sha256(params.encode()).hexdigest()[:16]}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+        if data is None and self.path is not None:
+            data = self._read(key)
+            if data is not None:
+                self._store(key, data)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        self._store(key, data)
+        if self.path is not None:
+            self._write(key, data)
+
+    def clear(self) -> None:
+        """Clear the in-memory cache and reset the hit/miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = 0
+
+    def _store(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        assert self.path is not None
+        filename = os.path.join(self.path, key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            # Update the modification time, which is used to pick entries to evict
+            os.utime(filename)
+        except OSError:
+            return None
+        return data
+
+    def _write(self, key: str, data: bytes) -> None:
+        assert self.path is not None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = os.path.join(self.path, f".{key}.{threading.get_ident()}")
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, os.path.join(self.path, key))
+
+            entries = [e for e in os.scandir(self.path) if not e.name.startswith(".")]
+            if len(entries) > self.max_disk_entries:
+                entries.sort(key=lambda e: e.stat().st_mtime)
+                for entry in entries[: len(entries) - self.max_disk_entries]:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+        except OSError:
+            log.exception("Unable to write to image cache at %s", self.path)
+
+
+# The cache used by `Image.resize_to_target`.
+resize_cache = ResizeCache()
@@ -0,0 +1,198 @@
+import logging
+import pickle
+import sqlite3
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future
+from time import time
+from typing import Any, Optional
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait before retrying a failed delivery. This doubles after each failure, up to
+# RETRY_MAX_DELAY.
+RETRY_DELAY = 10.0
+RETRY_MAX_DELAY = 3600.0
+# Number of delivery attempts before a post is given up on
+MAX_ATTEMPTS = 10
+# Seconds to wait for deliveries in progress when closing the outbox
+CLOSE_TIMEOUT = 10.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    service TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_service ON jobs (service, id);
+"""
+
+
+class Outbox:
+    """A queue of posts waiting to be delivered, stored in an SQLite database so that they
+    survive restarts.
+
+    Each service has a worker thread which delivers its posts in the order they were queued
+    by calling `deliver(service_name, payload)`. Failed deliveries are retried with
+    exponential backoff, unless the exception has a false `transient` attribute.
+
+    Delivery is at-least-once: a post which is still in progress when `close` stops waiting
+    for it will be delivered again next time.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        deliver: Callable[[str, Any], Any],
+        retry_delay: float = RETRY_DELAY,
+        retry_max_delay: float = RETRY_MAX_DELAY,
+        max_attempts: int = MAX_ATTEMPTS,
+    ) -> None:
+        self.path = path
+        self.deliver = deliver
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_attempts = max_attempts
+
+        # The connection is shared between threads, and only used while holding _lock
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        # Whether the database has been closed. Deliveries which finish after close() but
+        # before this are still recorded.
+        self._db_closed = False
+        self._workers: dict[str, threading.Thread] = {}
+        # Futures for posts queued by this process, keyed by job ID
+        self._futures: dict[int, Future] = {}
+
+    def put(self, service: str, payload: Any) -> Future:
+        """Queue a payload for delivery to a service. Returns a Future which resolves to the
+        result of `deliver`."""
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Outbox is closed")
+            cursor = self._db.execute(
+                "INSERT INTO jobs (service, payload, next_attempt) VALUES (?, ?, ?)",
+                (service, data, time()),
+            )
+            assert cursor.lastrowid is not None
+            self._futures[cursor.lastrowid] = future
+            self._wakeup.notify_all()
+        return future
+
+    def pending(self, service: Optional[str] = None) -> int:
+        """Return the number of posts waiting to be delivered."""
+        with self._lock:
+            if service is None:
+                row = self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()
+            else:
+                row = self._db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE service = ?", (service,)
+                ).fetchone()
+        return row[0]
+
+    def start(self, service: str) -> None:
+        """Start delivering posts to a service."""
+        with self._lock:
+            if self._closed or service in self._workers:
+                return
+            thread = threading.Thread(
+                target=self._run,
+                args=(service,),
+                name=f"polybot-outbox-{service}",
+                daemon=True,
+            )
+            self._workers[service] = thread
+        thread.start()
+
+    def close(self, timeout: Optional[float] = CLOSE_TIMEOUT) -> None:
+        """Stop the workers, waiting up to `timeout` seconds for deliveries in progress."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify_all()
+        for thread in self._workers.values():
+            thread.join(timeout)
+        with self._lock:
+            self._db_closed = True
+            self._db.close()
+
+    def _next_job(self, service: str) -> Optional[tuple[int, bytes, int]]:
+        """Wait until the oldest job for a service is due. Returns None if the outbox is
+        closed. Must be called while holding _lock."""
+        while not self._closed:
+            row = self._db.execute(
+                "SELECT id, payload, attempts, next_attempt FROM jobs "
+                "WHERE service = ? ORDER BY id LIMIT 1",
+                (service,),
+            ).fetchone()
+            delay = None
+            if row is not None:
+                delay = row[3] - time()
+                if delay <= 0:
+                    return row[0], row[1], row[2]
+            self._wakeup.wait(delay)
+        return None
+
+    def _run(self, service: str) -> None:
+        while True:
+            with self._lock:
+                job = self._next_job(service)
+            if job is None:
+                return
+            job_id, data, attempts = job
+
+            error = None
+            try:
+                result = self.deliver(service, pickle.loads(data))
+            except Exception as e:
+                error = e
+
+            with self._lock:
+                if self._db_closed:
+                    # close() gave up waiting for this delivery, so it'll be repeated
+                    return
+                attempts += 1
+                # Errors can say whether they're worth retrying, as PostErrors do
+                retry = getattr(error, "transient", True)
+                if error is None or not retry or attempts >= self.max_attempts:
+                    self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                    future = self._futures.pop(job_id, None)
+                else:
+                    delay = min(
+                        self.retry_delay * 2 ** (attempts - 1), self.retry_max_delay
+                    )
+                    self._db.execute(
+                        "UPDATE jobs SET attempts = ?, next_attempt = ? WHERE id = ?",
+                        (attempts, time() + delay, job_id),
+                    )
+                    log.warning(
+                        "Error posting to %s, retrying in %ss (%s)",
+                        service,
+                        delay,
+                        error,
+                    )
+                    continue
+
+            if error is None:
+                if future is not None:
+                    future.set_result(result)
+            else:
+                log.error(
+                    "Giving up posting to %s after %s attempts",
+                    service,
+                    attempts,
+                    exc_info=error,
+                )
+                if future is not None:
+                    future.set_exception(error)
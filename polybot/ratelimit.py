@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import threading
+from collections.abc import Mapping
+from datetime import datetime
+from time import sleep, time
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# Header prefixes used by services to report rate limits: Mastodon, Twitter, Bluesky
+HEADER_PREFIXES = ("x-ratelimit-", "x-rate-limit-", "ratelimit-")
+# Reset values smaller than this are a number of seconds from now rather than a timestamp
+MAX_RESET_DELTA = 10 * 365 * 24 * 60 * 60
+
+
+def parse_reset(value: Optional[str], now: float) -> Optional[float]:
+    """Parse a rate limit reset header into a Unix timestamp. Services send either a Unix
+    timestamp, a number of seconds, or (Mastodon) an ISO 8601 date."""
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+    if seconds < MAX_RESET_DELTA:
+        return now + seconds
+    return seconds
+
+
+class RateLimiter:
+    """A token bucket which schedules posts to stay within a service's rate limit.
+
+    `rate` is the number of posts allowed per hour (None for no limit), and `burst` is the
+    number of posts which can be made back-to-back. Independently of the bucket, the limiter
+    holds off posting until the reset time when the service reports in its response headers
+    that the limit has run out.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returning the number of seconds to wait before using it."""
+        with self._lock:
+            now = time()
+            delay = max(0.0, self._blocked_until - now)
+            if self.rate:
+                per_second = self.rate / 3600
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * per_second
+                )
+                self._updated = now
+                # Tokens go negative while posts are waiting, so that they're spaced out
+                self._tokens -= 1
+                if self._tokens < 0:
+                    delay = max(delay, -self._tokens / per_second)
+            return delay
+
+    def blocked_for(self) -> float:
+        """Return the number of seconds until the service's reported rate limit resets, if
+        it has run out."""
+        with self._lock:
+            return max(0.0, self._blocked_until - time())
+
+    def acquire(self) -> None:
+        """Wait until a post can be made."""
+        delay = self.reserve()
+        if delay > 0:
+            log.info("Rate limited, waiting %.1fs", delay)
+            sleep(delay)
+
+    async def acquire_async(self) -> None:
+        """Asynchronous version of `acquire`."""
+        delay = self.reserve()
+        if delay > 0:
+            log.info("Rate limited, waiting %.1fs", delay)
+            await asyncio.sleep(delay)
+
+    def update(self, remaining: Optional[int], reset: Optional[float]) -> None:
+        """Record the rate limit state reported by the service: the number of requests
+        remaining, and the Unix timestamp at which the limit resets."""
+        if remaining is None or reset is None or remaining > 0:
+            return
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, reset)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Record the rate limit state from a service's response headers."""
+        now = time()
+        headers = {k.lower(): v for k, v in headers.items()}
+        if "retry-after" in headers:
+            self.update(0, parse_reset(headers["retry-after"], now))
+            return
+        for prefix in HEADER_PREFIXES:
+            if prefix + "remaining" in headers:
+                try:
+                    remaining = int(headers[prefix + "remaining"])
+                except ValueError:
+                    return
+                self.update(remaining, parse_reset(headers.get(prefix + "reset"), now))
+                return
@@ -0,0 +1,244 @@
+import struct
+import sys
+import threading
+from array import array
+from hashlib import blake2b
+from time import time
+from typing import Optional, Union
+
+from .state import write_atomic
+
+Item = Union[str, bytes, int]
+
+# The table is kept at most this full, so that probe sequences stay short
+MAX_LOAD = 0.7
+# Initial number of slots. This must be a power of two.
+MIN_CAPACITY = 1024
+# An empty slot. Fingerprints are never zero.
+EMPTY = 0
+
+MAGIC = b"PBSEEN\x01"
+# Flags, item count and capacity
+HEADER = struct.Struct("<BQQ")
+FLAG_TIMES = 1
+FLAG_BIG_ENDIAN = 2
+
+# Timestamps are stored as unsigned 32-bit seconds
+TIME_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
+
+def fingerprint(item: Item) -> int:
+    """Return a non-zero 64-bit hash of an item. With 64 bits, the chance of any two of a
+    million items colliding is around one in 40 million."""
+    if isinstance(item, str):
+        data = b"s" + item.encode()
+    elif isinstance(item, bytes):
+        data = b"b" + item
+    elif isinstance(item, int):
+        data = b"i" + str(item).encode()
+    else:
+        raise TypeError(f"Can't add {type(item).__name__} to a SeenSet")
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), "little") or 1
+
+
+class SeenSet:
+    """A compact set of the items (strings, bytes or ints) which a bot has already seen.
+
+    Only a 64-bit fingerprint of each item is kept, in an open-addressing hash table. Each
+    slot takes 8 bytes (12 with a TTL), and the table is kept between 35% and 70% full as it
+    grows, so it takes 12 to 23 bytes per item (17 to 34 with a TTL) rather than the 100 or
+    more which a Python set of strings needs. The items themselves can't be retrieved.
+
+    If `ttl` is set, items are forgotten that many seconds after they were last added.
+    Expired items still count towards `len` until `expire` is called, which happens when
+    the table grows and when it's saved.
+    """
+
+    def __init__(
+        self, ttl: Optional[float] = None, capacity: int = MIN_CAPACITY
+    ) -> None:
+        self.ttl = ttl
+        # Whether the set has changed since it was last saved
+        self.changed = False
+        self._lock = threading.Lock()
+        self._reset(capacity)
+
+    def _reset(self, capacity: int) -> None:
+        self._slots = array("Q", bytes(8 * capacity))
+        self._times: Optional[array[int]] = None
+        if self.ttl is not None:
+            self._times = array(TIME_TYPECODE, bytes(4 * capacity))
+        self._mask = capacity - 1
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the table."""
+        size = self._slots.itemsize * len(self._slots)
+        if self._times is not None:
+            size += self._times.itemsize * len(self._times)
+        return size
+
+    def _find(self, fp: int) -> int:
+        """Return the slot holding a fingerprint, or the empty slot where it would go."""
+        slots, mask = self._slots, self._mask
+        i = fp & mask
+        while True:
+            value = slots[i]
+            if value == fp or value == EMPTY:
+                return i
+            i = (i + 1) & mask
+
+    def _expired(self, i: int, now: float) -> bool:
+        return (
+            self._times is not None
+            and self.ttl is not None
+            and now - self._times[i] > self.ttl
+        )
+
+    def __contains__(self, item: Item) -> bool:
+        fp = fingerprint(item)
+        with self._lock:
+            i = self._find(fp)
+            return self._slots[i] == fp and not self._expired(i, time())
+
+    def add(self, item: Item) -> bool:
+        """Add an item, returning True if it hadn't been seen before (or had expired)."""
+        fp = fingerprint(item)
+        now = time()
+        with self._lock:
+            i = self._find(fp)
+            if self._slots[i] == fp:
+                new = self._expired(i, now)
+            else:
+                if self._count + 1 > MAX_LOAD * len(self._slots):
+                    self._rebuild(len(self._slots) * 2, now)
+                    i = self._find(fp)
+                self._slots[i] = fp
+                self._count += 1
+                new = True
+            if self._times is not None:
+                self._times[i] = int(now)
+            self.changed = True
+            return new
+
+    def discard(self, item: Item) -> None:
+        """Remove an item, if it's present."""
+        fp = fingerprint(item)
+        with self._lock:
+            i = self._find(fp)
+            if self._slots[i] != fp:
+                return
+            self._remove(i)
+            self.changed = True
+
+    def _remove(self, i: int) -> None:
+        # Shift later entries in the probe sequence back, so that there are no gaps in it
+        slots, times, mask = self._slots, self._times, self._mask
+        j = i
+        while True:
+            j = (j + 1) & mask
+            value = slots[j]
+            if value == EMPTY:
+                break
+            home = value & mask
+            # Move the entry at j into the gap at i unless its home slot is between them
+            if (j > i and (home <= i or home > j)) or (
+                j < i and home <= i and home > j
+            ):
+                slots[i] = value
+                if times is not None:
+                    times[i] = times[j]
+                i = j
+        slots[i] = EMPTY
+        self._count -= 1
+
+    def expire(self) -> None:
+        """Remove expired items."""
+        if self.ttl is None:
+            return
+        with self._lock:
+            self._rebuild(len(self._slots), time())
+
+    def _rebuild(self, capacity: int, now: float) -> None:
+        slots, times = self._slots, self._times
+        while capacity > MIN_CAPACITY and self._count < MAX_LOAD * capacity / 4:
+            capacity //= 2
+        self._reset(capacity)
+        for i, value in enumerate(slots):
+            if value == EMPTY:
+                continue
+            stamp = int(now)
+            if times is not None:
+                stamp = times[i]
+                if self.ttl is not None and now - stamp > self.ttl:
+                    self.changed = True
+                    continue
+            j = self._find(value)
+            self._slots[j] = value
+            if self._times is not None:
+                self._times[j] = stamp
+            self._count += 1
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            flags = 0
+            if self._times is not None:
+                flags |= FLAG_TIMES
+            if sys.byteorder == "big":
+                flags |= FLAG_BIG_ENDIAN
+            parts = [
+                MAGIC,
+                HEADER.pack(flags, self._count, len(self._slots)),
+                self._slots.tobytes(),
+            ]
+            if self._times is not None:
+                parts.append(self._times.tobytes())
+            self.changed = False
+        try:
+            write_atomic(path, b"".join(parts))
+        except BaseException:
+            self.changed = True
+            raise
+
+    @classmethod
+    def load(cls, path: str, ttl: Optional[float] = None) -> "SeenSet":
+        """Load a SeenSet saved with `save`. Raises OSError if the file doesn't exist, and
+        ValueError if it's not valid."""
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"{path} is not a saved SeenSet")
+        offset = len(MAGIC)
+        flags, count, capacity = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+
+        seen = cls(ttl, capacity)
+        swap = bool(flags & FLAG_BIG_ENDIAN) != (sys.byteorder == "big")
+        seen._slots = array("Q")
+        seen._slots.frombytes(data[offset : offset + 8 * capacity])
+        offset += 8 * capacity
+        if swap:
+            seen._slots.byteswap()
+        if len(seen._slots) != capacity:
+            raise ValueError(f"{path} is truncated")
+        seen._count = count
+
+        if seen._times is not None:
+            if flags & FLAG_TIMES:
+                seen._times = array(TIME_TYPECODE)
+                seen._times.frombytes(data[offset : offset + 4 * capacity])
+                if swap:
+                    seen._times.byteswap()
+                if len(seen._times) != capacity:
+                    raise ValueError(f"{path} is truncated")
+            else:
+                # Items saved without timestamps expire from now
+                now = int(time())
+                for i, value in enumerate(seen._slots):
+                    if value != EMPTY:
+                        seen._times[i] = now
+        return seen
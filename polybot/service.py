@@ -1,17 +1,25 @@
+import asyncio
+import hashlib
+import json
 import logging
 import mimetypes
+import os
+import random
 import textwrap
+import threading
+import uuid
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, wait
 from importlib.metadata import PackageNotFoundError, version
-from io import BytesIO
-from time import time
-from typing import Optional, Union
+from time import sleep, time
+from typing import TYPE_CHECKING, Optional, Union
 
-import httpx
-from atproto import Client, models  # type: ignore
-from atproto_client.exceptions import RequestException  # type: ignore
-from mastodon import Mastodon as MastodonClient  # type: ignore
+from .image import Image, ImageLimit
+from .ratelimit import RateLimiter
 
-from .image import Image
+if TYPE_CHECKING:
+    import httpx
+    from atproto_client.exceptions import RequestException  # type: ignore
 
 try:
     POLYBOT_VERSION = version("polybot")
@@ -19,10 +27,99 @@ except PackageNotFoundError:
     POLYBOT_VERSION = "dev"
 
 
+# Default number of seconds to cache Mastodon instance info for
+INSTANCE_CACHE_TTL = 24 * 60 * 60
+# Mastodon instance info endpoints, in order of preference
+INSTANCE_ENDPOINTS = ["/api/v2/instance", "/api/v1/instance"]
+# Maximum number of seconds to wait for all Mastodon instance info requests to complete
+INSTANCE_INFO_TIMEOUT = 15
+# Seconds to wait between checks on whether Mastodon has finished processing uploaded media,
+# doubling up to MEDIA_POLL_MAX_DELAY, and how long to wait in total before giving up
+MEDIA_POLL_DELAY = 0.5
+MEDIA_POLL_MAX_DELAY = 5.0
+MEDIA_PROCESSING_TIMEOUT = 120
+
+# HTTP status codes which are worth retrying
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# Client library exceptions which are worth retrying, by class name so that the libraries
+# don't need to be imported to check them. Subclasses of these are also matched.
+TRANSIENT_ERRORS = {
+    "TransportError",  # httpx
+    "MastodonNetworkError",
+    "MastodonServerError",
+    "MastodonRatelimitError",
+    "TwitterServerError",
+    "TooManyRequests",  # tweepy
+    "NetworkError",  # atproto
+}
+# Exceptions which mean that a request never reached the service, because the connection
+# couldn't be made: httpx, requests and urllib3
+UNSENT_ERRORS = {"ConnectError", "ConnectTimeout", "NewConnectionError"}
+
+
+def is_transient(error: BaseException) -> bool:
+    """Return whether an error from a client library is likely to go away if the request is
+    retried: network errors, timeouts, rate limits and server errors. Other errors, such as
+    4xx responses, are permanent."""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status in TRANSIENT_STATUS_CODES
+    if any(cls.__name__ in TRANSIENT_ERRORS for cls in type(error).__mro__):
+        return True
+    return isinstance(error, (OSError, asyncio.TimeoutError))
+
+
+def is_unsent(error: BaseException) -> bool:
+    """Return whether a failed request clearly never reached the service, or was rejected
+    by its rate limit, so that retrying it can't repeat its effect. The exceptions which an
+    error wraps are also checked."""
+    pending: list = [error]
+    checked = set()
+    while pending:
+        e = pending.pop()
+        if not isinstance(e, BaseException) or id(e) in checked:
+            continue
+        checked.add(id(e))
+        if getattr(getattr(e, "response", None), "status_code", None) == 429:
+            return True
+        if any(cls.__name__ in UNSENT_ERRORS for cls in type(e).__mro__):
+            return True
+        pending.extend([e.__cause__, getattr(e, "reason", None), *e.args])
+    return False
+
+
+def media_poll_delays() -> Iterator[float]:
+    """Yield delays between checks on uploaded media, until MEDIA_PROCESSING_TIMEOUT."""
+    deadline = time() + MEDIA_PROCESSING_TIMEOUT
+    delay = MEDIA_POLL_DELAY
+    while time() + delay < deadline:
+        yield delay
+        delay = min(delay * 2, MEDIA_POLL_MAX_DELAY)
+
+
 class PostError(Exception):
     """Raised when there was an error posting"""
 
-    pass
+    def __init__(
+        self,
+        *args,
+        transient: Optional[bool] = None,
+        may_have_posted: bool = False,
+    ) -> None:
+        super().__init__(*args)
+        self._transient = transient
+        # Whether the request which failed may have created the post anyway, so that
+        # repeating it could post twice
+        self.may_have_posted = may_have_posted
+
+    @property
+    def transient(self) -> bool:
+        """Whether the post may succeed if it's retried. Unless this was given explicitly,
+        it depends on the exception which caused the error."""
+        if self._transient is not None:
+            return self._transient
+        cause = self.args[0] if self.args else None
+        return isinstance(cause, BaseException) and is_transient(cause)
 
 
 class Service:
@@ -33,18 +130,98 @@ class Service:
     max_image_size: int = int(10e6)
     max_image_pixels: Optional[int] = None
     max_image_count: int = 4
-
-    def __init__(self, config, live: bool) -> None:
+    # MIME types of images which the service accepts. None means any.
+    image_mime_types: Optional[tuple[str, ...]] = None
+    # Default number of posts allowed per hour (None for no limit), and how many can be made
+    # back-to-back. These can be set with rate_limit and rate_limit_burst in the service's
+    # config section.
+    rate_limit: Optional[float] = None
+    rate_limit_burst: int = 1
+    # Each step of a post (uploading an image, creating the status) which fails with a
+    # transient error is retried up to max_attempts times, with exponential backoff starting
+    # at retry_delay seconds, as long as the post can be finished within retry_deadline
+    # seconds. max_attempts and retry_deadline can also be set in the config section.
+    max_attempts: int = 3
+    retry_delay: float = 1.0
+    retry_max_delay: float = 30.0
+    retry_deadline: float = 120.0
+    # Whether the service uses the idempotency key passed to create_post to avoid creating
+    # a post twice. If not, creating a post is only retried when the failed request can't
+    # have reached the service, as it may have created the post before failing.
+    idempotent_posts = False
+    # Maximum number of images to upload at once
+    max_upload_workers: int = 4
+    # Seconds to remember uploaded images for, so that attaching the same image again
+    # doesn't upload it again. 0 disables this. It can also be set in the config section.
+    media_cache_ttl: float = 0
+
+    def __init__(self, config, live: bool, cache_path: Optional[str] = None) -> None:
         self.log = logging.getLogger(__name__)
         self.config = config
         self.live = live
         self.user_agent = (
             f"Polybot/{POLYBOT_VERSION} (https://github.com/russss/polybot)"
         )
+        self.cache_path = cache_path
+        self.cache = self.load_cache()
+        self.cache_lock = threading.Lock()
+
+        rate, burst = self.rate_limit, self.rate_limit_burst
+        if config is not None and config.has_section(self.name):
+            section = config[self.name]
+            rate = section.getfloat("rate_limit", rate)
+            burst = section.getint("rate_limit_burst", burst)
+            self.max_attempts = section.getint("max_attempts", self.max_attempts)
+            self.retry_deadline = section.getfloat(
+                "retry_deadline", self.retry_deadline
+            )
+            self.media_cache_ttl = section.getfloat(
+                "media_cache_ttl", self.media_cache_ttl
+            )
+        self.rate_limiter = RateLimiter(rate, burst)
+
+        # Shared between posts, so that uploads to the service are limited overall
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=self.max_upload_workers, thread_name_prefix="polybot-upload"
+        )
+        self._upload_limit: Optional[asyncio.Semaphore] = None
+
+    def load_cache(self) -> dict:
+        """Load the service's cache file, which holds data which is expensive to fetch but
+        can be thrown away at any time."""
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            self.log.exception("Unable to read cache file %s", self.cache_path)
+            return {}
+
+    def save_cache(self) -> None:
+        if self.cache_path is None:
+            return
+        with self.cache_lock:
+            tmp = self.cache_path + ".tmp"
+            try:
+                # The cache may hold session tokens, so keep it private
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with open(fd, "w") as f:
+                    json.dump(self.cache, f)
+                os.replace(tmp, self.cache_path)
+            except OSError:
+                self.log.exception("Unable to write cache file %s", self.cache_path)
 
     def auth(self) -> None:
         raise NotImplementedError()
 
+    async def auth_async(self) -> None:
+        """Authenticate for use from an asyncio event loop. By default this runs `auth` in a
+        worker thread."""
+        await asyncio.to_thread(self.auth)
+
     def setup(self) -> bool:
         raise NotImplementedError()
 
@@ -64,17 +241,59 @@ class Service:
         lat: Optional[float] = None,
         lon: Optional[float] = None,
         in_reply_to_id=None,
+        idempotency_key: Optional[str] = None,
     ):
-        images = [
-            i.resize_to_target(self.max_image_size, self.max_image_pixels)
-            for i in images[: self.max_image_count]
-        ]
+        """Post to the service. `idempotency_key` identifies the post, so that delivering
+        it again (from the outbox) doesn't post it twice on services which support it.
+        """
+        images = self.prepare_images(images)
+        if self.live:
+            if wrap:
+                return self.do_wrapped(
+                    status, images, lat, lon, in_reply_to_id, idempotency_key
+                )
+            if isinstance(status, list):
+                status = self.longest_allowed(status, images)
+            self.rate_limiter.acquire()
+            return self.do_post(
+                status, images, lat, lon, in_reply_to_id, idempotency_key
+            )
+
+    async def post_async(
+        self,
+        status: Union[str, list[str]],
+        wrap=False,
+        images: list[Image] = [],
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+        in_reply_to_id=None,
+        idempotency_key: Optional[str] = None,
+    ):
+        """Asynchronous version of `post`."""
+        if images:
+            images = await asyncio.to_thread(self.prepare_images, images)
         if self.live:
             if wrap:
-                return self.do_wrapped(status, images, lat, lon, in_reply_to_id)
+                return await self.do_wrapped_async(
+                    status, images, lat, lon, in_reply_to_id, idempotency_key
+                )
             if isinstance(status, list):
                 status = self.longest_allowed(status, images)
-            return self.do_post(status, images, lat, lon, in_reply_to_id)
+            await self.rate_limiter.acquire_async()
+            return await self.do_post_async(
+                status, images, lat, lon, in_reply_to_id, idempotency_key
+            )
+
+    @property
+    def image_limit(self) -> ImageLimit:
+        return (self.max_image_size, self.max_image_pixels, self.image_mime_types)
+
+    def prepare_images(self, images: list[Image]) -> list[Image]:
+        """Resize images to fit within this service's limits."""
+        return [
+            i.resize_to_target(*self.image_limit)
+            for i in images[: self.max_image_count]
+        ]
 
     def do_post(
         self,
@@ -83,9 +302,331 @@ class Service:
         lat: Optional[float] = None,
         lon: Optional[float] = None,
         in_reply_to_id=None,
+        idempotency_key: Optional[str] = None,
+    ):
+        """Upload the images and create the post, retrying each step separately, so that
+        images aren't uploaded again if creating the post fails.
+
+        Uploaded images are only added to the media cache once the post has been created.
+        If creating a post with cached images fails, they may no longer exist on the
+        service, so they're uploaded again and creating the post is retried once."""
+        idempotency_key = idempotency_key or uuid.uuid4().hex
+        reused = self.media_cached(images)
+        media = self.upload_images(images)
+        try:
+            result = self.with_retries(
+                self.create_post,
+                status,
+                media,
+                lat,
+                lon,
+                in_reply_to_id,
+                idempotency_key,
+                unsent_only=not self.idempotent_posts,
+            )
+        except PostError as error:
+            # Only post again if the post definitely wasn't created
+            if not reused or not self.safe_to_repost(error):
+                raise
+            self.log.warning("Error posting with reused images, uploading them again")
+            self.forget_media(images)
+            media = self.upload_images(images)
+            result = self.with_retries(
+                self.create_post,
+                status,
+                media,
+                lat,
+                lon,
+                in_reply_to_id,
+                idempotency_key,
+                unsent_only=not self.idempotent_posts,
+            )
+        self.cache_media(images, media)
+        return result
+
+    async def do_post_async(
+        self,
+        status: str,
+        images: list[Image] = [],
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+        in_reply_to_id=None,
+        idempotency_key: Optional[str] = None,
+    ):
+        """Asynchronous version of `do_post`. By default this runs `do_post` in a worker
+        thread; services with an asynchronous client should override it, and can use
+        `upload_and_post_async`."""
+        return await asyncio.to_thread(
+            self.do_post, status, images, lat, lon, in_reply_to_id, idempotency_key
+        )
+
+    async def upload_and_post_async(
+        self,
+        status: str,
+        images: list[Image] = [],
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+        in_reply_to_id=None,
+        idempotency_key: Optional[str] = None,
     ):
+        """Asynchronous version of `do_post` which uses `upload_image_async` and
+        `create_post_async`."""
+        idempotency_key = idempotency_key or uuid.uuid4().hex
+        reused = self.media_cached(images)
+        media = await self.upload_images_async(images)
+        try:
+            result = await self.with_retries_async(
+                self.create_post_async,
+                status,
+                media,
+                lat,
+                lon,
+                in_reply_to_id,
+                idempotency_key,
+                unsent_only=not self.idempotent_posts,
+            )
+        except PostError as error:
+            # Only post again if the post definitely wasn't created
+            if not reused or not self.safe_to_repost(error):
+                raise
+            self.log.warning("Error posting with reused images, uploading them again")
+            self.forget_media(images)
+            media = await self.upload_images_async(images)
+            result = await self.with_retries_async(
+                self.create_post_async,
+                status,
+                media,
+                lat,
+                lon,
+                in_reply_to_id,
+                idempotency_key,
+                unsent_only=not self.idempotent_posts,
+            )
+        self.cache_media(images, media)
+        return result
+
+    def safe_to_repost(self, error: PostError) -> bool:
+        """Whether creating a post can be tried again after it failed with `error`: it was
+        rejected (such as for referring to media which no longer exists), or the request
+        never reached the service."""
+        if error.may_have_posted:
+            return False
+        return not error.transient or is_unsent(error)
+
+    def upload_images(self, images: list[Image]) -> list:
+        """Upload images concurrently, up to `max_upload_workers` at a time, retrying each
+        one separately. Images which were uploaded recently are reused (see
+        `media_cache_ttl`)."""
+        if len(images) <= 1 or self.max_upload_workers == 1:
+            return [self.upload_cached(image) for image in images]
+        return list(self.upload_executor.map(self.upload_cached, images))
+
+    def upload_cached(self, image: Image):
+        media = self.cached_media(self.media_key(image))
+        if media is None:
+            media = self.with_retries(self.upload_image, image)
+        return media
+
+    async def upload_images_async(self, images: list[Image]) -> list:
+        """Asynchronous version of `upload_images`."""
+        if self._upload_limit is None:
+            self._upload_limit = asyncio.Semaphore(self.max_upload_workers)
+        limit = self._upload_limit
+
+        async def upload(image: Image):
+            media = self.cached_media(self.media_key(image))
+            if media is None:
+                async with limit:
+                    media = await self.with_retries_async(
+                        self.upload_image_async, image
+                    )
+            return media
+
+        return list(await asyncio.gather(*(upload(image) for image in images)))
+
+    def media_key(self, image: Image) -> str:
+        """The media cache key for an image: a hash of its data and description."""
+        description = (image.description or "").encode()
+        return hashlib.sha256(image.digest.encode() + b":" + description).hexdigest()
+
+    def cached_media(self, key: str):
+        """Return the result of uploading an image previously, if it hasn't expired."""
+        if not self.media_cache_ttl:
+            return None
+        entry = self.cache.get("media", {}).get(key)
+        if entry is None or entry["expires"] < time():
+            return None
+        self.log.debug("Reusing uploaded image %s", key)
+        return self.load_media(entry["media"])
+
+    def media_cached(self, images: list[Image]) -> bool:
+        """Whether any of the images will be reused from the media cache."""
+        if not self.media_cache_ttl:
+            return False
+        now = time()
+        cached = self.cache.get("media", {})
+        return any(
+            self.media_key(image) in cached
+            and cached[self.media_key(image)]["expires"] >= now
+            for image in images
+        )
+
+    def cache_media(self, images: list[Image], media: list) -> None:
+        """Remember images which have been uploaded and used in a post. Images which were
+        already cached keep their original expiry time, as the service may expire them
+        from when they were uploaded."""
+        if not self.media_cache_ttl:
+            return
+        now = time()
+        with self.cache_lock:
+            cached = {
+                k: v
+                for k, v in self.cache.get("media", {}).items()
+                if v["expires"] >= now
+            }
+            for image, item in zip(images, media):
+                key = self.media_key(image)
+                if item is not None and key not in cached:
+                    cached[key] = {
+                        "media": self.dump_media(item),
+                        "expires": now + self.media_cache_ttl,
+                    }
+            self.cache["media"] = cached
+        self.save_cache()
+
+    def forget_media(self, images: list[Image]) -> None:
+        """Remove images from the media cache."""
+        with self.cache_lock:
+            cached = self.cache.get("media", {})
+            for image in images:
+                cached.pop(self.media_key(image), None)
+        self.save_cache()
+
+    def dump_media(self, media):
+        """Convert the result of `upload_image` to JSON for the media cache."""
+        return media
+
+    def load_media(self, data):
+        """Convert media stored by `dump_media` back into the result of `upload_image`."""
+        return data
+
+    def upload_image(self, image: Image):
+        """Upload an image, returning a reference to be passed to `create_post`."""
         raise NotImplementedError()
 
+    async def upload_image_async(self, image: Image):
+        """Asynchronous version of `upload_image`. By default this runs `upload_image` in a
+        worker thread."""
+        return await asyncio.to_thread(self.upload_image, image)
+
+    def create_post(
+        self,
+        status: str,
+        media: list,
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+        in_reply_to_id=None,
+        idempotency_key: Optional[str] = None,
+    ):
+        """Create a post with media previously returned by `upload_image`.
+        `idempotency_key` is the same for each attempt at creating the post."""
+        raise NotImplementedError()
+
+    async def create_post_async(
+        self,
+        status: str,
+        media: list,
+        lat: Optional[float] = None,
+        lon: Optional[float] = None,
+        in_reply_to_id=None,
+        idempotency_key: Optional[str] = None,
+    ):
+        """Asynchronous version of `create_post`. By default this runs `create_post` in a
+        worker thread."""
+        return await asyncio.to_thread(
+            self.create_post,
+            status,
+            media,
+            lat,
+            lon,
+            in_reply_to_id,
+            idempotency_key,
+        )
+
+    def retry_backoff(self, attempt: int) -> float:
+        """Return the number of seconds to wait before retrying after a failed attempt, with
+        jitter so that retries from several bots don't all arrive at once."""
+        delay = min(self.retry_delay * 2 ** (attempt - 1), self.retry_max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def post_error(self, error: Exception) -> PostError:
+        """Wrap an exception from a client library in a PostError."""
+        if isinstance(error, PostError):
+            return error
+        self.update_rate_limit(error)
+        return PostError(error)
+
+    def should_retry(self, error: PostError, attempt: int, deadline: float) -> float:
+        """Return the number of seconds to wait before retrying a failed step, or 0 if it
+        shouldn't be retried."""
+        if not error.transient or attempt >= self.max_attempts:
+            return 0
+        delay = max(self.retry_backoff(attempt), self.rate_limiter.blocked_for())
+        if time() + delay > deadline:
+            return 0
+        self.log.warning(
+            "Error posting to %s (attempt %d), retrying in %.1fs: %s",
+            self.name,
+            attempt,
+            delay,
+            error,
+        )
+        return delay
+
+    def with_retries(self, step, *args, unsent_only: bool = False):
+        """Call a step of posting, retrying it if it fails with a transient error, or with
+        `unsent_only`, only if the request never reached the service. All exceptions are
+        raised as PostErrors."""
+        deadline = time() + self.retry_deadline
+        attempt = 1
+        while True:
+            try:
+                return step(*args)
+            except Exception as e:
+                error = self.post_error(e)
+                delay = 0.0
+                if not unsent_only or is_unsent(error):
+                    delay = self.should_retry(error, attempt, deadline)
+                elif error.transient:
+                    # The post may have been created, so it mustn't be retried at all,
+                    # including by the outbox
+                    raise PostError(*error.args, transient=False, may_have_posted=True)
+                if not delay:
+                    raise error
+            sleep(delay)
+            attempt += 1
+
+    async def with_retries_async(self, step, *args, unsent_only: bool = False):
+        """Asynchronous version of `with_retries`, for steps which are coroutines."""
+        deadline = time() + self.retry_deadline
+        attempt = 1
+        while True:
+            try:
+                return await step(*args)
+            except Exception as e:
+                error = self.post_error(e)
+                delay = 0.0
+                if not unsent_only or is_unsent(error):
+                    delay = self.should_retry(error, attempt, deadline)
+                elif error.transient:
+                    # The post may have been created, so it mustn't be retried at all,
+                    # including by the outbox
+                    raise PostError(*error.args, transient=False, may_have_posted=True)
+                if not delay:
+                    raise error
+            await asyncio.sleep(delay)
+            attempt += 1
+
     def do_wrapped(
         self,
         status,
@@ -93,37 +634,86 @@ class Service:
         lat=None,
         lon=None,
         in_reply_to_id=None,
+        idempotency_key=None,
     ):
-        max_len = self.max_length_image if images else self.max_length
-        if len(status) > max_len:
-            wrapped = textwrap.wrap(status, max_len - self.ellipsis_length)
-        else:
-            wrapped = [status]
         first = True
-        for line in wrapped:
-            if first and len(wrapped) > 1:
-                line = line + "\u2026"
-            if not first:
-                line = "\u2026" + line
-
+        for i, line in enumerate(self.wrap_lines(status, images)):
+            key = f"{idempotency_key}-{i}" if idempotency_key else None
+            self.rate_limiter.acquire()
             if images and first:
-                out = self.do_post(line, images, lat, lon, in_reply_to_id)
+                out = self.do_post(line, images, lat, lon, in_reply_to_id, key)
             else:
                 out = self.do_post(
-                    line, lat=lat, lon=lon, in_reply_to_id=in_reply_to_id
+                    line,
+                    lat=lat,
+                    lon=lon,
+                    in_reply_to_id=in_reply_to_id,
+                    idempotency_key=key,
                 )
+            in_reply_to_id = self.reply_id(out, first, in_reply_to_id)
+            first = False
 
-            if isinstance(out, models.com.atproto.repo.strong_ref.Main):
-                if first:
-                    in_reply_to_id = {"root": out, "parent": out}
-                else:
-                    in_reply_to_id["parent"] = out
-            elif hasattr(out, "id"):
-                in_reply_to_id = out.id
+    async def do_wrapped_async(
+        self,
+        status,
+        images: list[Image] = [],
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        first = True
+        for i, line in enumerate(self.wrap_lines(status, images)):
+            key = f"{idempotency_key}-{i}" if idempotency_key else None
+            await self.rate_limiter.acquire_async()
+            if images and first:
+                out = await self.do_post_async(
+                    line, images, lat, lon, in_reply_to_id, key
+                )
             else:
-                in_reply_to_id = out.data["id"]
+                out = await self.do_post_async(
+                    line,
+                    lat=lat,
+                    lon=lon,
+                    in_reply_to_id=in_reply_to_id,
+                    idempotency_key=key,
+                )
+            in_reply_to_id = self.reply_id(out, first, in_reply_to_id)
             first = False
 
+    def wrap_lines(self, status: str, images: list[Image]) -> list[str]:
+        """Split a status into lines which fit within the post length limit, adding
+        ellipses to show where the status has been split."""
+        max_len = self.max_length_image if images else self.max_length
+        if len(status) > max_len:
+            wrapped = textwrap.wrap(status, max_len - self.ellipsis_length)
+        else:
+            wrapped = [status]
+        lines = []
+        for i, line in enumerate(wrapped):
+            if i == 0 and len(wrapped) > 1:
+                line = line + "\u2026"
+            if i > 0:
+                line = "\u2026" + line
+            lines.append(line)
+        return lines
+
+    def update_rate_limit(self, error: Exception) -> None:
+        """Record the rate limit headers from the response attached to a failed request's
+        exception, if there is one."""
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers is not None:
+            self.rate_limiter.update_from_headers(headers)
+
+    def reply_id(self, out, first: bool, in_reply_to_id):
+        """Return the ID to reply to in order to continue a thread, given the result of
+        the previous `do_post` call."""
+        if isinstance(out, dict):
+            return out["id"]
+        if hasattr(out, "id"):
+            return out.id
+        return out.data["id"]
+
 
 class Twitter(Service):
     name = "twitter"
@@ -131,6 +721,9 @@ class Twitter(Service):
     max_length_image = 280 - 25
     ellipsis_length = 2
     max_image_size = int(5e6)
+    image_mime_types = ("image/gif", "image/jpeg", "image/png", "image/webp")
+    # Twitter media IDs can be used for 24 hours after uploading
+    media_cache_ttl = 23 * 60 * 60
 
     def auth(self):
         import tweepy  # type: ignore
@@ -182,42 +775,33 @@ class Twitter(Service):
 
         return True
 
-    def do_post(
+    def upload_image(self, image: Image):
+        if not image.mime_type:
+            self.log.warning("Not uploading image with no MIME type to Twitter")
+            return None
+        ext = mimetypes.guess_extension(image.mime_type)
+        if not ext:
+            self.log.warning("MIME type %s not recognized", image.mime_type)
+            return None
+        with image.open() as f:
+            media = self.tweepy_v1.media_upload("dummy" + ext, file=f)
+        return media.media_id
+
+    def create_post(
         self,
         status,
-        images: list[Image] = [],
+        media,
         lat=None,
         lon=None,
         in_reply_to_id=None,
+        idempotency_key=None,
     ):
-        try:
-            media_ids = []
-            if images:
-                for image in images:
-                    if image.mime_type:
-                        ext = mimetypes.guess_extension(image.mime_type)
-                        if not ext:
-                            self.log.warning(
-                                "MIME type %s not recognized", image.mime_type
-                            )
-                            continue
-                        filename = "dummy" + ext
-                    else:
-                        self.log.warning(
-                            "Not uploading image with no MIME type to Twitter"
-                        )
-                        continue
-                    media = self.tweepy_v1.media_upload(
-                        filename, file=BytesIO(image.data)
-                    )
-                    media_ids.append(media.media_id)
-            return self.tweepy.create_tweet(
-                text=status,
-                in_reply_to_tweet_id=in_reply_to_id,
-                media_ids=media_ids if media_ids else None,
-            )
-        except Exception as e:
-            raise PostError(e)
+        media_ids = [m for m in media if m is not None]
+        return self.tweepy.create_tweet(
+            text=status,
+            in_reply_to_tweet_id=in_reply_to_id,
+            media_ids=media_ids if media_ids else None,
+        )
 
 
 class Mastodon(Service):
@@ -226,12 +810,21 @@ class Mastodon(Service):
     max_length = 500
     max_length_image = 500
     max_image_size = int(16e6)
+    image_mime_types = ("image/gif", "image/jpeg", "image/png", "image/webp")
+    # Media can only be attached to one status, so uploads can't be reused
+    media_cache_ttl = 0
+    # Posts are sent with an Idempotency-Key header, so retrying them is safe
+    idempotent_posts = True
+
+    def __init__(self, config, live: bool, cache_path: Optional[str] = None):
+        super().__init__(config, live, cache_path)
+        import httpx
 
-    def __init__(self, config, live: bool):
-        super().__init__(config, live)
         self.http = httpx.Client(headers={"User-Agent": self.user_agent})
 
     def auth(self):
+        from mastodon import Mastodon as MastodonClient  # type: ignore
+
         self.update_instance_info()
 
         base_url = self.config.get("mastodon", "base_url")
@@ -253,6 +846,22 @@ class Mastodon(Service):
             self.max_image_pixels,
         )
 
+    async def auth_async(self):
+        import httpx
+
+        await asyncio.to_thread(self.update_instance_info)
+
+        base_url = self.config.get("mastodon", "base_url")
+        self.async_http = httpx.AsyncClient(
+            base_url=base_url,
+            headers={
+                "User-Agent": self.user_agent,
+                "Authorization": "Bearer "
+                + self.config.get("mastodon", "access_token"),
+            },
+        )
+        self.log.info("Connected to %s at %s (async)", self.software, base_url)
+
     def fetch_endpoint(self, path):
         base_url = self.config.get("mastodon", "base_url")
         if base_url is None:
@@ -285,51 +894,165 @@ class Mastodon(Service):
     def update_instance_info(self):
         """Fetch and save details about the instance we're connecting to, including software type
         and post size limits.
+
+        The node software and instance endpoints are requested concurrently, with an overall
+        deadline of `INSTANCE_INFO_TIMEOUT` seconds.
+
+        If the service has a cache file, the details are cached for `instance_cache_ttl`
+        seconds (which can be set in the mastodon config section). After that they're
+        revalidated with a conditional request, which returns the new details if they've
+        changed. If the instance can't be reached, the cached details are used until the
+        next attempt.
         """
+        import httpx
 
-        self.software = self.get_node_software()
+        base_url = self.config.get("mastodon", "base_url")
+        ttl = self.config.getint(
+            "mastodon", "instance_cache_ttl", fallback=INSTANCE_CACHE_TTL
+        )
 
-        instance_info = self.fetch_endpoint("/api/v1/instance")
-        if not instance_info:
-            return
+        cached = self.cache.get("instance")
+        if cached is not None and cached.get("base_url") != base_url:
+            cached = None
+
+        headers = {}
+        if cached is not None:
+            if time() - cached["fetched"] < ttl:
+                self.log.debug("Using cached instance info for %s", base_url)
+                self.apply_instance_info(cached["info"])
+                return
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+            try:
+                res = self.fetch_instance(cached["endpoint"], headers)
+            except httpx.HTTPError:
+                # Fetching it in full would fail too
+                self.log.warning(
+                    "Unable to revalidate instance info for %s, using cached info",
+                    base_url,
+                )
+                self.apply_instance_info(cached["info"])
+                return
+            if res.status_code == 304:
+                self.log.debug("Cached instance info for %s is still valid", base_url)
+                cached["fetched"] = time()
+                self.save_cache()
+                self.apply_instance_info(cached["info"])
+                return
+            if res.status_code == 200:
+                self.log.debug("Instance info for %s has changed", base_url)
+                info = {"software": cached["info"].get("software")}
+                info.update(self.parse_instance_info(res.json()))
+                self.cache_instance_info(base_url, cached["endpoint"], res, info)
+                self.apply_instance_info(info)
+                return
 
+        # Node software and the instance endpoints are independent, so fetch them all at
+        # once. Newer servers provide /api/v2/instance, which we prefer.
+        executor = ThreadPoolExecutor(max_workers=1 + len(INSTANCE_ENDPOINTS))
         try:
-            image_size = int(
-                instance_info["configuration"]["media_attachments"]["image_size_limit"]
-            )
-        except Exception:
-            image_size = self.max_image_size
+            software = executor.submit(self.get_node_software)
+            instance = {
+                endpoint: executor.submit(self.fetch_instance, endpoint)
+                for endpoint in INSTANCE_ENDPOINTS
+            }
+            wait([software, *instance.values()], timeout=INSTANCE_INFO_TIMEOUT)
+        finally:
+            executor.shutdown(wait=False)
+
+        info = {"software": None}
+        if software.done() and not software.exception():
+            info["software"] = software.result()
+        else:
+            self.log.warning("Unable to fetch node software for %s", base_url)
+
+        errors = []
+        for endpoint, future in instance.items():
+            if not future.done():
+                continue
+            if future.exception():
+                errors.append(future.exception())
+                continue
+            res = future.result()
+            if res.status_code != 200:
+                continue
+
+            info.update(self.parse_instance_info(res.json()))
+            self.cache_instance_info(base_url, endpoint, res, info)
+            break
+        else:
+            if errors and len(errors) == len(instance):
+                raise errors[0]
+            self.log.warning("Unable to fetch instance info for %s", base_url)
+        self.apply_instance_info(info)
+
+    def cache_instance_info(
+        self, base_url: str, endpoint: str, res: "httpx.Response", info: dict
+    ) -> None:
+        if self.cache_path is None:
+            return
+        self.cache["instance"] = {
+            "base_url": base_url,
+            "endpoint": endpoint,
+            "fetched": time(),
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "info": info,
+        }
+        self.save_cache()
+
+    def fetch_instance(self, endpoint: str, headers: dict = {}) -> "httpx.Response":
+        base_url = self.config.get("mastodon", "base_url")
+        return self.http.get(base_url + endpoint, headers=headers)
 
+    def parse_instance_info(self, instance_info: dict) -> dict:
+        """Extract post and image limits from the response of the instance endpoint. Limits
+        which the instance doesn't provide are omitted."""
+        info: dict = {}
         try:
-            image_pixels = int(
-                instance_info["configuration"]["media_attachments"][
-                    "image_matrix_limit"
-                ]
-            )
+            media = instance_info["configuration"]["media_attachments"]
         except Exception:
-            image_pixels = self.max_image_pixels
-
+            media = {}
         try:
-            max_length = int(
-                instance_info["configuration"]["statuses"]["max_characters"]
-            )
+            statuses = instance_info["configuration"]["statuses"]
         except Exception:
-            max_length = self.max_length
+            statuses = {}
+
+        for key, section, field in [
+            ("max_image_size", media, "image_size_limit"),
+            ("max_image_pixels", media, "image_matrix_limit"),
+            ("max_length", statuses, "max_characters"),
+            ("max_image_count", statuses, "max_media_attachments"),
+        ]:
+            try:
+                info[key] = int(section[field])
+            except Exception:
+                pass
 
         try:
-            max_image_count = int(
-                instance_info["configuration"]["statuses"]["max_media_attachments"]
-            )
+            info["image_mime_types"] = [
+                t for t in media["supported_mime_types"] if t.startswith("image/")
+            ]
         except Exception:
-            max_image_count = self.max_image_count
-
-        self.max_image_size = image_size
-        self.max_length = max_length
-        self.max_length_image = max_length
-        self.max_image_pixels = image_pixels
-        self.max_image_count = max_image_count
+            pass
+        return info
+
+    def apply_instance_info(self, info: dict) -> None:
+        self.software = info.get("software")
+        self.max_image_size = info.get("max_image_size", self.max_image_size)
+        self.max_image_pixels = info.get("max_image_pixels", self.max_image_pixels)
+        self.max_length = info.get("max_length", self.max_length)
+        self.max_length_image = self.max_length
+        self.max_image_count = info.get("max_image_count", self.max_image_count)
+        if "image_mime_types" in info:
+            self.image_mime_types = tuple(info["image_mime_types"])
 
     def setup(self):
+        from mastodon import Mastodon as MastodonClient  # type: ignore
+
         print()
         print(
             "First, we'll need the base URL of the Mastodon instance you want to connect to,"
@@ -395,33 +1118,109 @@ class Mastodon(Service):
 
         return True
 
-    def do_post(
+    def upload_image(self, image: Image):
+        try:
+            with image.open() as f:
+                media = self.mastodon.media_post(
+                    f,
+                    mime_type=image.mime_type,
+                    description=image.description,
+                    synchronous=False,
+                )
+            # Large media is processed after uploading, and has no URL until it's done.
+            # Images are uploaded concurrently, so they're also waited for concurrently.
+            delays = media_poll_delays()
+            while media.get("url") is None:
+                delay = next(delays, None)
+                if delay is None:
+                    raise PostError("Timed out waiting for Mastodon to process media")
+                sleep(delay)
+                media = self.mastodon.media(media["id"])
+            return media
+        finally:
+            self.update_mastodon_rate_limit()
+
+    def create_post(
         self,
         status,
-        images: list[Image] = [],
+        media,
         lat=None,
         lon=None,
         in_reply_to_id=None,
+        idempotency_key=None,
     ):
         try:
-            if images:
-                media = [
-                    self.mastodon.media_post(
-                        image.data,
-                        mime_type=image.mime_type,
-                        description=image.description,
-                    )
-                    for image in images
-                ]
-            else:
-                media = None
-
             return self.mastodon.status_post(
-                status, in_reply_to_id=in_reply_to_id, media_ids=media
+                status,
+                in_reply_to_id=in_reply_to_id,
+                media_ids=media or None,
+                idempotency_key=idempotency_key,
+            )
+        finally:
+            self.update_mastodon_rate_limit()
+
+    def update_mastodon_rate_limit(self) -> None:
+        # Mastodon.py waits for rate limits itself, but we can avoid hitting them
+        self.rate_limiter.update(
+            self.mastodon.ratelimit_remaining, self.mastodon.ratelimit_reset
+        )
+
+    async def do_post_async(
+        self,
+        status,
+        images: list[Image] = [],
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        return await self.upload_and_post_async(
+            status, images, lat, lon, in_reply_to_id, idempotency_key
+        )
+
+    async def upload_image_async(self, image: Image):
+        with image.open() as f:
+            res = await self.async_http.post(
+                "/api/v2/media",
+                files={"file": ("image", f, image.mime_type)},
+                data={"description": image.description} if image.description else None,
             )
-        except Exception as e:
-            # Mastodon.py exceptions are currently changing so catchall here for the moment
-            raise PostError(e)
+        res.raise_for_status()
+        media_id = res.json()["id"]
+
+        # 202 means the media is still being processed, and polling it returns 206 until
+        # it's done
+        delays = media_poll_delays()
+        while res.status_code in (202, 206):
+            delay = next(delays, None)
+            if delay is None:
+                raise PostError("Timed out waiting for Mastodon to process media")
+            await asyncio.sleep(delay)
+            res = await self.async_http.get(f"/api/v1/media/{media_id}")
+            res.raise_for_status()
+        return media_id
+
+    async def create_post_async(
+        self,
+        status,
+        media,
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        data: dict = {"status": status}
+        if in_reply_to_id:
+            data["in_reply_to_id"] = in_reply_to_id
+        if media:
+            data["media_ids"] = media
+        headers = {}
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        res = await self.async_http.post("/api/v1/statuses", json=data, headers=headers)
+        self.rate_limiter.update_from_headers(res.headers)
+        res.raise_for_status()
+        return res.json()
 
 
 class Bluesky(Service):
@@ -430,20 +1229,37 @@ class Bluesky(Service):
     max_length_image = 300
     # As of 2024-12-03 the maximum image size allowed on Bluesky is 1 metric megabyte.
     max_image_size = int(1e6)
+    image_mime_types = ("image/jpeg", "image/png", "image/webp")
+    # Blobs stay available while a post refers to them, so can be reused for a while
+    media_cache_ttl = 7 * 24 * 60 * 60
 
-    def __init__(self, config, live: bool):
-        super().__init__(config, live)
+    def __init__(self, config, live: bool, cache_path: Optional[str] = None):
+        super().__init__(config, live, cache_path)
         self.login_ratelimit_expiry = 0
         self.connected = False
 
     def auth(self):
+        from atproto import Client  # type: ignore
+        from atproto_client.exceptions import (  # type: ignore
+            AtProtocolError,
+            RequestException,
+        )
+
         self.bluesky = Client()
-        if self.login_ratelimit_expiry > time():
-            self.log.warning(
-                "Not connecting to Bluesky as login rate limit is still active. "
-                "Will re-attempt connection in %d seconds.",
-                self.login_ratelimit_expiry - time(),
-            )
+        self.bluesky.on_session_change(self.session_changed)
+
+        session = self.cache.get("session")
+        if session:
+            try:
+                self.bluesky.login(session_string=session)
+            except (AtProtocolError, ValueError):
+                self.log.info("Unable to resume Bluesky session, logging in again")
+            else:
+                self.connected = True
+                self.log.info("Connected to Bluesky (resumed session)")
+                return
+
+        if self.login_ratelimited():
             return
 
         try:
@@ -452,19 +1268,80 @@ class Bluesky(Service):
                 self.config.get("bluesky", "password"),
             )
         except RequestException as e:
-            if e.response.status_code == 429:
-                self.login_ratelimit_expiry = int(e.response.headers["ratelimit-reset"])
-                self.log.warning(
-                    "Rate-limited by Bluesky when connecting. "
-                    "Will re-attempt connection in %d seconds.",
-                    self.login_ratelimit_expiry - time(),
-                )
-                return
-            raise
+            self.handle_login_error(e)
+            return
 
         self.connected = True
         self.log.info("Connected to Bluesky")
 
+    async def auth_async(self):
+        from atproto import AsyncClient  # type: ignore
+        from atproto_client.exceptions import (  # type: ignore
+            AtProtocolError,
+            RequestException,
+        )
+
+        self.bluesky = AsyncClient()
+        self.bluesky.on_session_change(self.session_changed)
+
+        session = self.cache.get("session")
+        if session:
+            try:
+                await self.bluesky.login(session_string=session)
+            except (AtProtocolError, ValueError):
+                self.log.info("Unable to resume Bluesky session, logging in again")
+            else:
+                self.connected = True
+                self.log.info("Connected to Bluesky (async, resumed session)")
+                return
+
+        if self.login_ratelimited():
+            return
+
+        try:
+            await self.bluesky.login(
+                self.config.get("bluesky", "email"),
+                self.config.get("bluesky", "password"),
+            )
+        except RequestException as e:
+            self.handle_login_error(e)
+            return
+
+        self.connected = True
+        self.log.info("Connected to Bluesky (async)")
+
+    def session_changed(self, event, session) -> None:
+        """Save the session whenever the client logs in or refreshes its tokens, so that the
+        next start can resume it rather than logging in with the password again. The client
+        refreshes the access token itself shortly before it expires."""
+        from atproto import SessionEvent  # type: ignore
+
+        if event == SessionEvent.IMPORT:
+            return
+        self.cache["session"] = session.encode()
+        self.save_cache()
+
+    def login_ratelimited(self) -> bool:
+        if self.login_ratelimit_expiry > time():
+            self.log.warning(
+                "Not connecting to Bluesky as login rate limit is still active. "
+                "Will re-attempt connection in %d seconds.",
+                self.login_ratelimit_expiry - time(),
+            )
+            return True
+        return False
+
+    def handle_login_error(self, e: "RequestException") -> None:
+        if e.response.status_code == 429:
+            self.login_ratelimit_expiry = int(e.response.headers["ratelimit-reset"])
+            self.log.warning(
+                "Rate-limited by Bluesky when connecting. "
+                "Will re-attempt connection in %d seconds.",
+                self.login_ratelimit_expiry - time(),
+            )
+            return
+        raise e
+
     def setup(self):
         print("We need your Bluesky email and password")
         email = input("Email: ")
@@ -481,6 +1358,7 @@ class Bluesky(Service):
         lat=None,
         lon=None,
         in_reply_to_id=None,
+        idempotency_key=None,
     ):
         if not self.connected:
             self.auth()
@@ -489,27 +1367,111 @@ class Bluesky(Service):
             self.log.warning("Skipping Bluesky post, not connected")
             return
 
-        if in_reply_to_id:
-            in_reply_to_id = models.AppBskyFeedPost.ReplyRef(
-                parent=in_reply_to_id["parent"], root=in_reply_to_id["root"]
-            )
-        try:
-            if len(images) > 0:
-                resp = self.bluesky.send_images(
-                    status,
-                    [i.data for i in images],
-                    [i.description for i in images],
-                    self.bluesky.me.did,
-                    in_reply_to_id,
-                )
-            else:
-                resp = self.bluesky.send_post(
-                    status, self.bluesky.me.did, in_reply_to_id
-                )
-            return models.create_strong_ref(resp)
+        return super().do_post(
+            status, images, lat, lon, in_reply_to_id, idempotency_key
+        )
+
+    def upload_image(self, image: Image):
+        # atproto only accepts bytes, but Bluesky images are small
+        res = self.bluesky.upload_blob(image.data)
+        return self.embed_image(image, res.blob)
+
+    def create_post(
+        self,
+        status,
+        media,
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        from atproto import models  # type: ignore
 
-        except Exception as e:
-            raise PostError(e)
+        resp = self.bluesky.send_post(
+            status,
+            self.bluesky.me.did,
+            self.reply_ref(in_reply_to_id),
+            embed=self.embed(media),
+        )
+        return models.create_strong_ref(resp)
+
+    async def do_post_async(
+        self,
+        status,
+        images: list[Image] = [],
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        if not self.connected:
+            await self.auth_async()
+
+        if not self.connected:
+            self.log.warning("Skipping Bluesky post, not connected")
+            return
+
+        return await self.upload_and_post_async(
+            status, images, lat, lon, in_reply_to_id, idempotency_key
+        )
+
+    async def upload_image_async(self, image: Image):
+        res = await self.bluesky.upload_blob(image.data)
+        return self.embed_image(image, res.blob)
+
+    async def create_post_async(
+        self,
+        status,
+        media,
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        from atproto import models  # type: ignore
+
+        resp = await self.bluesky.send_post(
+            status,
+            self.bluesky.me.did,
+            self.reply_ref(in_reply_to_id),
+            embed=self.embed(media),
+        )
+        return models.create_strong_ref(resp)
+
+    def dump_media(self, media):
+        return media.model_dump(mode="json", by_alias=True, exclude_none=True)
+
+    def load_media(self, data):
+        from atproto import models  # type: ignore
+
+        return models.AppBskyEmbedImages.Image.model_validate(data)
+
+    def embed_image(self, image: Image, blob):
+        from atproto import models  # type: ignore
+
+        return models.AppBskyEmbedImages.Image(alt=image.description or "", image=blob)
+
+    def embed(self, media: list):
+        from atproto import models  # type: ignore
+
+        if not media:
+            return None
+        return models.AppBskyEmbedImages.Main(images=media)
+
+    def reply_id(self, out, first: bool, in_reply_to_id):
+        if first:
+            return {"root": out, "parent": out}
+        in_reply_to_id["parent"] = out
+        return in_reply_to_id
+
+    def reply_ref(self, in_reply_to_id):
+        from atproto import models  # type: ignore
+
+        if not in_reply_to_id:
+            return None
+        return models.AppBskyFeedPost.ReplyRef(
+            parent=in_reply_to_id["parent"], root=in_reply_to_id["root"]
+        )
 
 
 ALL_SERVICES: list[type[Service]] = [Twitter, Mastodon, Bluesky]
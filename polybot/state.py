@@ -0,0 +1,526 @@
+import gzip
+import json
+import logging
+import lzma
+import os
+import pickle
+import sqlite3
+import threading
+from collections.abc import Callable, Iterator, MutableMapping
+from functools import partial
+from time import monotonic
+from typing import Any, NamedTuple, Optional
+
+log = logging.getLogger(__name__)
+
+# Values of these types can't be modified in place, so reading them doesn't make them dirty
+IMMUTABLE_TYPES = (str, bytes, int, float, complex, bool, type(None), tuple, frozenset)
+# Number of times a background save is attempted if the state changes while it's being
+# written
+SAVE_ATTEMPTS = 3
+# Seconds to wait before trying again after a background save fails
+SAVE_RETRY_DELAY = 10.0
+# Seconds between checks on the number of changes made to the state, when autosaving after a
+# number of changes
+CHANGE_POLL_INTERVAL = 1.0
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write a file by writing a temporary file and renaming it over the original, so that
+    a crash part way through leaves the previous version intact."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _json_dumps(state: Any) -> bytes:
+    return json.dumps(state, separators=(",", ":")).encode()
+
+
+def _msgpack_dumps(state: Any) -> bytes:
+    import msgpack  # type: ignore
+
+    return msgpack.packb(state, use_bin_type=True)
+
+
+def _msgpack_loads(data: bytes) -> Any:
+    import msgpack  # type: ignore
+
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def _pickle_dumps(state: Any) -> bytes:
+    return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+
+def _zstd_compress(data: bytes) -> bytes:
+    try:
+        from compression import zstd  # type: ignore
+    except ImportError:
+        import zstandard  # type: ignore
+
+        return zstandard.ZstdCompressor().compress(data)
+    return zstd.compress(data)
+
+
+def _zstd_decompress(data: bytes) -> bytes:
+    try:
+        from compression import zstd  # type: ignore
+    except ImportError:
+        import zstandard  # type: ignore
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zstd.decompress(data)
+
+
+# Serialisation formats for the state, as (dumps, loads). msgpack needs the msgpack package.
+STATE_FORMATS: dict[str, tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    "pickle": (_pickle_dumps, pickle.loads),
+    "json": (_json_dumps, json.loads),
+    "msgpack": (_msgpack_dumps, _msgpack_loads),
+}
+# Compression formats, as (header, compress, decompress). zstd needs Python 3.14 or the
+# zstandard package.
+STATE_COMPRESSIONS: dict[
+    str, tuple[bytes, Callable[[bytes], bytes], Callable[[bytes], bytes]]
+] = {
+    "gzip": (b"\x1f\x8b", partial(gzip.compress, compresslevel=6), gzip.decompress),
+    "lzma": (b"\xfd7zXZ\x00", lzma.compress, lzma.decompress),
+    "zstd": (b"\x28\xb5\x2f\xfd", _zstd_compress, _zstd_decompress),
+}
+
+
+class StateCodec:
+    """Converts the state to and from bytes. `name` is a format from STATE_FORMATS,
+    optionally followed by "+" and a compression from STATE_COMPRESSIONS, such as
+    "pickle+zstd".
+
+    Compressed data is recognised by its header, and pickled data can be loaded whatever the
+    format, so existing state can still be loaded after changing the codec.
+    """
+
+    def __init__(self, name: str = "pickle") -> None:
+        format, _, compression = name.partition("+")
+        if format not in STATE_FORMATS:
+            raise ValueError(f"Unknown state format: {format}")
+        if compression and compression not in STATE_COMPRESSIONS:
+            raise ValueError(f"Unknown state compression: {compression}")
+        self.name = name
+        self._dumps, self._loads = STATE_FORMATS[format]
+        self._compress = None
+        if compression:
+            self._compress = STATE_COMPRESSIONS[compression][1]
+
+    def dumps(self, state: Any) -> bytes:
+        data = self._dumps(state)
+        if self._compress is not None:
+            data = self._compress(data)
+        return data
+
+    def loads(self, data: bytes) -> Any:
+        for header, _compress, decompress in STATE_COMPRESSIONS.values():
+            if data.startswith(header):
+                data = decompress(data)
+                break
+        # Pickles start with a PROTO opcode. No other format can start with this byte and
+        # continue.
+        if len(data) > 1 and data[0] == pickle.PROTO[0]:
+            return pickle.loads(data)
+        return self._loads(data)
+
+
+class StateDict(MutableMapping):
+    """A dict which keeps track of which keys have changed since the state was last saved.
+
+    Like `shelve` with writeback enabled, a key whose value is mutable is assumed to have
+    changed whenever it's read, because the value may have been modified in place. So a
+    large set which is read for membership checks is saved in full each time; `SeenSet`
+    suits that better.
+    """
+
+    def __init__(self, data: Optional[dict] = None) -> None:
+        self._data = data if data is not None else {}
+        self._dirty: set[str] = set()
+        self._deleted: set[str] = set()
+        # The number of changes made, for autosaving
+        self.mutations = 0
+        # Changes may be collected by a background thread, or by a signal handler which
+        # interrupts a change
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._data[key]
+        if not isinstance(value, IMMUTABLE_TYPES):
+            with self._lock:
+                self._dirty.add(key)
+                self.mutations += 1
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if not isinstance(key, str):
+            raise TypeError(f"State keys must be strings, not {type(key).__name__}")
+        with self._lock:
+            self._data[key] = value
+            self._dirty.add(key)
+            self._deleted.discard(key)
+            self.mutations += 1
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            del self._data[key]
+            self._dirty.discard(key)
+            self._deleted.add(key)
+            self.mutations += 1
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f"StateDict({self._data!r})"
+
+    def touch(self) -> None:
+        """Mark every key as changed."""
+        with self._lock:
+            self._dirty = set(self._data)
+
+    def changes(self) -> tuple[dict[str, Any], set[str]]:
+        """Return the items which have changed and the keys which have been deleted since
+        the last call."""
+        with self._lock:
+            changed = {key: self._data[key] for key in self._dirty if key in self._data}
+            deleted = self._deleted
+            self._dirty = set()
+            self._deleted = set()
+        return changed, deleted
+
+    def unsaved(self, changed: dict[str, Any], deleted: set[str]) -> None:
+        """Restore changes returned by `changes` which couldn't be saved."""
+        with self._lock:
+            self._dirty |= changed.keys() & self._data.keys()
+            self._deleted |= deleted - self._data.keys()
+
+
+class StateBackend:
+    """Loads and saves a bot's state, given the path of its state file and the codec to
+    store it with.
+
+    Saving is split in two, so that it can be written in the background: `snapshot`
+    serialises the state, and must be called on the thread which changes it so that it's
+    consistent, and `write` writes the snapshot to disk, which can be done on any thread.
+    """
+
+    def __init__(self, path: str, codec: Optional[StateCodec] = None) -> None:
+        self.path = path
+        self.codec = codec or StateCodec()
+
+    def load(self) -> Any:
+        """Load the state. Raises OSError if there's no saved state."""
+        raise NotImplementedError()
+
+    def snapshot(self, state: Any) -> Any:
+        raise NotImplementedError()
+
+    def write(self, snapshot: Any) -> None:
+        raise NotImplementedError()
+
+    def merge(self, older: Any, newer: Any) -> Any:
+        """Combine two snapshots which haven't been written yet."""
+        return newer
+
+    def save(self, state: Any) -> None:
+        self.write(self.snapshot(state))
+
+    def close(self) -> None:
+        pass
+
+
+class PickleBackend(StateBackend):
+    """Saves the whole state to a file each time. With the default codec, the state can be
+    any picklable object."""
+
+    def load(self) -> Any:
+        with open(self.path, "rb") as f:
+            return self.codec.loads(f.read())
+
+    def snapshot(self, state: Any) -> Optional[bytes]:
+        if len(state) == 0:
+            return None
+        return self.codec.dumps(state)
+
+    def write(self, snapshot: Optional[bytes]) -> None:
+        if snapshot is not None:
+            write_atomic(self.path, snapshot)
+
+    def merge(self, older: Optional[bytes], newer: Optional[bytes]) -> Optional[bytes]:
+        return older if newer is None else newer
+
+
+class SQLiteSnapshot(NamedTuple):
+    # The StateDict the changes were taken from
+    state: StateDict
+    # Whether to replace all the saved state, rather than update it
+    replace: bool
+    # Serialised values of the keys which have changed
+    rows: dict[str, bytes]
+    deleted: set[str]
+
+
+class SQLiteBackend(StateBackend):
+    """Stores each key of the state in a row of an SQLite database next to the state file,
+    and only writes the keys which have changed since the last save. The state is a
+    `StateDict`, its keys must be strings, and each value is stored with the codec.
+
+    If there's no database yet but there is a state file, it's imported.
+    """
+
+    def __init__(self, path: str, codec: Optional[StateCodec] = None) -> None:
+        super().__init__(path, codec)
+        self.db_path = path + ".db"
+        self._db: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+            )
+        return self._db
+
+    def load(self) -> StateDict:
+        new = not os.path.exists(self.db_path)
+        db = self.connect()
+        if new and os.path.exists(self.path):
+            log.info("Importing state from %s", self.path)
+            state = StateDict(dict(PickleBackend(self.path, self.codec).load()))
+            state.touch()
+            self.save(state)
+            return state
+        rows = db.execute("SELECT key, value FROM state")
+        return StateDict({key: self.codec.loads(value) for key, value in rows})
+
+    def snapshot(self, state: Any) -> SQLiteSnapshot:
+        replace = not isinstance(state, StateDict)
+        if replace:
+            # The bot has replaced its state with another mapping, so rewrite all of it
+            state = StateDict(dict(state))
+            state.touch()
+        changed, deleted = state.changes()
+        try:
+            rows = {key: self.codec.dumps(value) for key, value in changed.items()}
+        except BaseException:
+            state.unsaved(changed, deleted)
+            raise
+        return SQLiteSnapshot(state, replace, rows, deleted)
+
+    def write(self, snapshot: SQLiteSnapshot) -> None:
+        db = self.connect()
+        try:
+            with db:
+                if snapshot.replace:
+                    db.execute("DELETE FROM state")
+                db.executemany(
+                    "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                    snapshot.rows.items(),
+                )
+                db.executemany(
+                    "DELETE FROM state WHERE key = ?",
+                    ((key,) for key in snapshot.deleted),
+                )
+        except BaseException:
+            snapshot.state.unsaved(snapshot.rows, snapshot.deleted)
+            raise
+
+    def merge(self, older: SQLiteSnapshot, newer: SQLiteSnapshot) -> SQLiteSnapshot:
+        if newer.replace:
+            return newer
+        rows = {
+            key: value for key, value in older.rows.items() if key not in newer.deleted
+        }
+        rows.update(newer.rows)
+        deleted = (older.deleted - newer.rows.keys()) | newer.deleted
+        return SQLiteSnapshot(newer.state, older.replace, rows, deleted)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+STATE_BACKENDS: dict[str, type[StateBackend]] = {
+    "pickle": PickleBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+class StateWriter:
+    """Saves the state in a background thread, every `interval` seconds and/or once
+    `max_changes` changes have been made to it, as counted by `count_changes`, and whenever
+    `request` is called.
+
+    `snapshot` serialises the state and `write` writes a snapshot to disk, and `merge`
+    combines two snapshots which haven't been written yet, like the methods of
+    `StateBackend`. A snapshot which can't be written is tried again, along with any newer
+    ones, after SAVE_RETRY_DELAY seconds.
+
+    Periodic saves take their snapshot with `background_snapshot`, which defaults to
+    `snapshot`, on the writer thread. Unless it hands the work to the thread which changes
+    the state, the state may change while it's being serialised, so the snapshot may not be
+    consistent. Pickling it may also fail with a RuntimeError, so this is attempted up to
+    SAVE_ATTEMPTS times.
+    """
+
+    def __init__(
+        self,
+        snapshot: Callable[[], Any],
+        write: Callable[[Any], None],
+        merge: Callable[[Any, Any], Any] = lambda older, newer: newer,
+        interval: Optional[float] = None,
+        max_changes: Optional[int] = None,
+        count_changes: Callable[[], int] = lambda: 0,
+        background_snapshot: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        self.snapshot = snapshot
+        self.write = write
+        self.merge = merge
+        self.interval = interval
+        self.max_changes = max_changes
+        self.count_changes = count_changes
+        self.background_snapshot = background_snapshot or snapshot
+        self._wakeup = threading.Condition()
+        # Held while taking the pending snapshot and writing it, so that snapshots are
+        # written in the order they were taken
+        self._write_lock = threading.RLock()
+        self._stopped = False
+        # The snapshot waiting to be written, if _has_pending is set
+        self._pending: Any = None
+        self._has_pending = False
+        # Saves aren't attempted before this time after one fails
+        self._retry_at = 0.0
+        self._thread = threading.Thread(
+            target=self._run, name="polybot-state", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the writer, waiting for any save in progress to finish."""
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify_all()
+        self._thread.join()
+
+    def request(self) -> None:
+        """Take a snapshot of the state now, and write it in the background as soon as
+        possible. Call this on the thread which changes the state, such as from a signal
+        handler, so that the snapshot is consistent. Snapshots which haven't been written
+        yet are combined into one save."""
+        self._add(self.snapshot())
+
+    def flush(self, snapshot: Any) -> None:
+        """Write a snapshot now, on the calling thread, after any which are waiting to be
+        written."""
+        with self._write_lock:
+            has_pending, pending = self._take()
+            if has_pending:
+                snapshot = self.merge(pending, snapshot)
+            self.write(snapshot)
+
+    def _add(self, snapshot: Any, older: bool = False) -> None:
+        with self._wakeup:
+            if self._has_pending:
+                if older:
+                    snapshot = self.merge(snapshot, self._pending)
+                else:
+                    snapshot = self.merge(self._pending, snapshot)
+            self._pending = snapshot
+            self._has_pending = True
+            self._wakeup.notify_all()
+
+    def _take(self) -> tuple[bool, Any]:
+        with self._wakeup:
+            pending = self._has_pending, self._pending
+            self._pending = None
+            self._has_pending = False
+        return pending
+
+    def _due(self, last_save: float, last_count: int) -> bool:
+        if monotonic() < self._retry_at:
+            return False
+        if self._has_pending:
+            return True
+        if self.interval is not None and monotonic() - last_save >= self.interval:
+            return True
+        if self.max_changes is not None:
+            return self.count_changes() - last_count >= self.max_changes
+        return False
+
+    def _timeout(self, last_save: float) -> Optional[float]:
+        now = monotonic()
+        if now < self._retry_at:
+            return self._retry_at - now
+        timeouts = []
+        if self.interval is not None:
+            timeouts.append(max(0.0, last_save + self.interval - now))
+        if self.max_changes is not None:
+            timeouts.append(CHANGE_POLL_INTERVAL)
+        return min(timeouts, default=None)
+
+    def _run(self) -> None:
+        last_save = monotonic()
+        last_count = self.count_changes()
+        while True:
+            with self._wakeup:
+                while not self._stopped and not self._due(last_save, last_count):
+                    self._wakeup.wait(self._timeout(last_save))
+                if self._stopped:
+                    return
+            started = monotonic()
+            count = self.count_changes()
+            # If the save fails, it's still due once the retry delay has passed
+            if self._save():
+                last_save = started
+                last_count = count
+
+    def _save(self) -> bool:
+        """Write the pending snapshot, taking one first if there isn't one. Returns whether
+        the save succeeded."""
+        with self._wakeup:
+            has_pending = self._has_pending
+        if not has_pending:
+            for attempt in range(1, SAVE_ATTEMPTS + 1):
+                try:
+                    self._add(self.background_snapshot(), older=True)
+                    break
+                except RuntimeError:
+                    if attempt == SAVE_ATTEMPTS:
+                        log.warning("State changed while saving, will try again later")
+                        return self._failed()
+                except Exception:
+                    log.exception("Error saving state")
+                    return self._failed()
+
+        with self._write_lock:
+            has_pending, snapshot = self._take()
+            if not has_pending:
+                # It's already been written by flush
+                return True
+            try:
+                self.write(snapshot)
+            except Exception:
+                log.exception("Error saving state")
+                self._add(snapshot, older=True)
+                return self._failed()
+        return True
+
+    def _failed(self) -> bool:
+        with self._wakeup:
+            self._retry_at = monotonic() + SAVE_RETRY_DELAY
+        return False
@@ -1,4 +1,8 @@
-from polybot import Bot
+import asyncio
+import time
+
+from polybot import AsyncBot, Bot
+from polybot.service import PostError, Service
 
 
 class BotTest(Bot):
@@ -6,8 +10,147 @@ class BotTest(Bot):
         pass
 
 
+class AsyncBotTest(AsyncBot):
+    async def main(self):
+        pass
+
+
 def test_init():
     # Very basic test to exercise the initialisation code
     bot = BotTest("test_bot")
     assert bot.name == "test_bot"
     bot.run()
+
+
+class SlowService(Service):
+    def __init__(self, name, delay, fail=False):
+        super().__init__(None, True)
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+
+    def do_post(
+        self,
+        status,
+        images=[],
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        time.sleep(self.delay)
+        if self.fail:
+            raise PostError("failed")
+        return (self.name, status, in_reply_to_id)
+
+
+def test_concurrent_post():
+    bot = BotTest("test_bot")
+    bot.services = [
+        SlowService("a", 0.2),
+        SlowService("b", 0.2),
+        SlowService("c", 0, True),
+    ]
+
+    start = time.monotonic()
+    out = bot.post("Hello", in_reply_to_id={"a": 1, "b": 2, "c": 3})
+    assert time.monotonic() - start < 0.35
+    assert out == {"a": ("a", "Hello", 1), "b": ("b", "Hello", 2)}
+
+
+def test_post_timeout():
+    bot = BotTest("test_bot")
+    bot.post_timeout = 0.1
+    bot.services = [SlowService("fast", 0), SlowService("slow", 0.5)]
+    assert bot.post("Hello") == {"fast": ("fast", "Hello", None)}
+
+
+def test_async_post():
+    bot = AsyncBotTest("test_bot")
+    bot.services = [
+        SlowService("a", 0.2),
+        SlowService("b", 0.2),
+        SlowService("c", 0, True),
+    ]
+
+    start = time.monotonic()
+    out = asyncio.run(bot.post("Hello", in_reply_to_id={"a": 1, "b": 2, "c": 3}))
+    assert time.monotonic() - start < 0.35
+    assert out == {"a": ("a", "Hello", 1), "b": ("b", "Hello", 2)}
+
+
+class AuthService(SlowService):
+    def __init__(self, name, delay, failures=0):
+        super().__init__(name, 0)
+        self.auth_delay = delay
+        self.failures = failures
+
+    def auth(self):
+        time.sleep(self.auth_delay)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("auth failed")
+
+
+class ConnectBotTest(BotTest):
+    auth_timeout = 0.2
+    auth_retry_delay = 0.05
+
+    def __init__(self, services):
+        super().__init__("test_bot")
+        self.to_create = services
+
+    def configured_services(self):
+        return self.to_create
+
+    def create_service(self, svc):
+        return svc
+
+
+class AsyncConnectBotTest(ConnectBotTest, AsyncBotTest):
+    pass
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_connect_services():
+    bot = ConnectBotTest(
+        [AuthService("a", 0.1), AuthService("b", 0.1), AuthService("slow", 0.5)]
+        + [AuthService("flaky", 0, failures=2)]
+    )
+    start = time.monotonic()
+    bot.connect_services()
+    assert time.monotonic() - start < 0.4
+    assert [s.name for s in bot.services] == ["a", "b"]
+    assert set(bot.degraded) == {"slow", "flaky"}
+    assert set(bot.post("Hello")) == {"a", "b"}
+
+    assert wait_for(lambda: not bot.degraded)
+    assert {s.name for s in bot.services} == {"a", "b", "slow", "flaky"}
+
+
+def test_connect_services_async():
+    bot = AsyncConnectBotTest(
+        [AuthService("a", 0.1), AuthService("slow", 0.5)]
+        + [AuthService("flaky", 0, failures=2)]
+    )
+
+    async def run():
+        start = time.monotonic()
+        await bot.connect_services_async()
+        assert time.monotonic() - start < 0.4
+        assert [s.name for s in bot.services] == ["a"]
+        assert set(bot.degraded) == {"slow", "flaky"}
+
+        for _ in range(200):
+            if not bot.degraded:
+                break
+            await asyncio.sleep(0.01)
+        assert {s.name for s in bot.services} == {"a", "slow", "flaky"}
+
+    asyncio.run(run())
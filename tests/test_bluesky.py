@@ -0,0 +1,66 @@
+import configparser
+
+import atproto  # type: ignore
+from atproto import Session, SessionEvent  # type: ignore
+from atproto_client.exceptions import UnauthorizedError  # type: ignore
+
+from polybot.service import Bluesky
+
+
+class MockClient:
+    logins: list = []
+
+    def __init__(self):
+        self.callbacks = []
+
+    def on_session_change(self, callback):
+        self.callbacks.append(callback)
+
+    def login(self, login=None, password=None, session_string=None):
+        if session_string:
+            self.logins.append("session")
+            if session_string.startswith("expired"):
+                raise UnauthorizedError()
+            event = SessionEvent.IMPORT
+            session = Session.decode(session_string)
+        else:
+            self.logins.append("password")
+            event = SessionEvent.CREATE
+            session = Session("test.bsky.social", "did:plc:test", "access", "refresh")
+        for callback in self.callbacks:
+            callback(event, session)
+
+    def refresh(self):
+        session = Session("test.bsky.social", "did:plc:test", "access2", "refresh2")
+        for callback in self.callbacks:
+            callback(SessionEvent.REFRESH, session)
+
+
+def test_session_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(atproto, "Client", MockClient)
+    monkeypatch.setattr(MockClient, "logins", [])
+    config = configparser.ConfigParser()
+    config["bluesky"] = {"email": "test@example.com", "password": "password"}
+    cache_path = str(tmp_path / "bot.bluesky.cache")
+
+    bluesky = Bluesky(config, True, cache_path=cache_path)
+    bluesky.auth()
+    assert bluesky.connected
+    assert MockClient.logins == ["password"]
+
+    # A new process resumes the saved session
+    bluesky = Bluesky(config, True, cache_path=cache_path)
+    bluesky.auth()
+    assert bluesky.connected
+    assert MockClient.logins == ["password", "session"]
+
+    # Refreshed tokens are saved
+    bluesky.bluesky.refresh()
+    bluesky = Bluesky(config, True, cache_path=cache_path)
+    assert Session.decode(bluesky.cache["session"]).refresh_jwt == "refresh2"
+
+    # An unusable session falls back to logging in with the password
+    bluesky.cache["session"] = "expired::::"
+    bluesky.auth()
+    assert bluesky.connected
+    assert MockClient.logins[-2:] == ["session", "password"]
@@ -1,9 +1,11 @@
 from io import BytesIO
 from pathlib import Path
 
+import pytest
 from PIL import Image as PILImage
+from PIL import ImageFilter
 
-from polybot.image import Image
+from polybot.image import RESIZE_POLICIES, Image, resize_cache
 
 
 def count_pixels(image):
@@ -29,3 +31,164 @@ def test_image_resize():
     for target_pixels in (1200 * 1200, 1000 * 1000):
         resized = img.resize_to_target(5000000, target_pixels)
         assert count_pixels(resized) <= target_pixels
+
+
+def test_resize_for_limits():
+    img = Image(
+        path=Path(__file__).parent / "images" / "sample.png", mime_type="image/png"
+    )
+    original_size = len(img.data)
+    limits = [
+        (original_size + 1, None, None),
+        (1500000, None, None),
+        (1000000, None, None),
+        (5000000, 1000 * 1000, None),
+    ]
+
+    variants = img.resize_for_limits(limits + limits)
+    assert set(variants) == set(limits)
+    assert variants[(original_size + 1, None, None)] is img
+    for (target_bytes, target_pixels, _), resized in variants.items():
+        assert len(resized.data) <= target_bytes
+        if target_pixels:
+            assert count_pixels(resized) <= target_pixels
+        assert resized.fits(target_bytes, target_pixels)
+
+
+def test_resize_cache(tmp_path):
+    resize_cache.clear()
+    resize_cache.path = tmp_path
+    try:
+        img = Image(
+            path=Path(__file__).parent / "images" / "sample.png", mime_type="image/png"
+        )
+        first = img.resize_to_target(1000000)
+        assert (resize_cache.hits, resize_cache.misses) == (0, 1)
+
+        second = img.resize_to_target(1000000)
+        assert (resize_cache.hits, resize_cache.misses) == (1, 1)
+        assert second.data == first.data
+        assert second.mime_type == "image/png"
+
+        # Served from disk once the in-memory cache is empty
+        resize_cache.clear()
+        third = img.resize_to_target(1000000)
+        assert (resize_cache.hits, resize_cache.misses) == (1, 0)
+        assert third.data == first.data
+
+        # Hits on converted images have the converted MIME type
+        lossy = Image(
+            path=Path(__file__).parent / "images" / "sample.png",
+            mime_type="image/png",
+            allow_lossy=True,
+        )
+        converted = lossy.resize_to_target(200000)
+        assert converted.mime_type == "image/webp"
+        assert lossy.resize_to_target(200000).mime_type == "image/webp"
+        jpeg = img.resize_to_target(200000, mime_types=["image/jpeg"])
+        assert jpeg.mime_type == "image/jpeg"
+        assert img.resize_to_target(200000, mime_types=["image/jpeg"]).mime_type == (
+            "image/jpeg"
+        )
+    finally:
+        resize_cache.path = None
+        resize_cache.clear()
+
+
+def test_resize_policies():
+    bands = [
+        PILImage.effect_noise((2000, 1500), 40).filter(ImageFilter.GaussianBlur(1))
+        for _ in range(3)
+    ]
+    buf = BytesIO()
+    PILImage.merge("RGB", bands).save(buf, format="JPEG", quality=92)
+
+    for policy in RESIZE_POLICIES:
+        img = Image(data=buf.getvalue(), mime_type="image/jpeg", resize_policy=policy)
+        resized = img.resize_to_target(100000)
+        assert len(resized.data) <= 100000
+        assert resized.resize_policy == policy
+        assert PILImage.open(BytesIO(resized.data)).format == "JPEG"
+
+
+def test_reencode():
+    img = Image(
+        path=Path(__file__).parent / "images" / "sample.png", mime_type="image/png"
+    )
+    original_pixels = count_pixels(img)
+
+    # Converting to an accepted format
+    resized = img.resize_to_target(len(img.data), mime_types=["image/jpeg"])
+    assert resized.mime_type == "image/jpeg"
+    assert PILImage.open(BytesIO(resized.data)).format == "JPEG"
+
+    # Lossy conversion is only used when allowed, and avoids reducing the size
+    resized = img.resize_to_target(500000)
+    assert resized.mime_type == "image/png"
+    assert count_pixels(resized) < original_pixels
+
+    img.allow_lossy = True
+    resized = img.resize_to_target(500000, mime_types=["image/png", "image/webp"])
+    assert resized.mime_type == "image/webp"
+    assert len(resized.data) <= 500000
+    assert count_pixels(resized) == original_pixels
+
+
+def test_palette():
+    img = PILImage.new("RGB", (2000, 2000))
+    for x in range(0, 2000, 100):
+        img.paste((x % 256, 0, 255 - x % 256), (x, 0, x + 50, 2000))
+    buf = BytesIO()
+    img.save(buf, format="PNG", compress_level=0)
+    image = Image(data=buf.getvalue(), mime_type="image/png")
+
+    resized = image.resize_to_target(len(image.data) // 10)
+    assert resized.mime_type == "image/png"
+    assert count_pixels(resized) == 2000 * 2000
+    assert PILImage.open(BytesIO(resized.data)).mode == "P"
+
+
+def test_unreadable_image():
+    # Pillow can't read HEIC, but services may accept it
+    img = Image(data=b"\x00\x00\x00\x18ftypheic", mime_type="image/heic")
+    assert img.resize_to_target(1000, 1000000, ["image/heic", "image/png"]) is img
+    assert img.resize_to_target(1000, None, ["image/png"]) is img
+    with pytest.raises(PILImage.UnidentifiedImageError):
+        img.resize_to_target(10)
+
+
+def test_mpo_image():
+    # Camera JPEGs are often read as MPO
+    buf = BytesIO()
+    frames = [PILImage.new("RGB", (64, 64), colour) for colour in ("red", "blue")]
+    frames[0].save(buf, format="MPO", save_all=True, append_images=frames[1:])
+    img = Image(data=buf.getvalue(), mime_type="image/jpeg")
+    assert img.format == "MPO"
+    assert img.resize_to_target(100000, None, ["image/jpeg", "image/png"]) is img
+
+    resized = img.resize_to_target(100000, 1024, ["image/jpeg", "image/png"])
+    assert resized.format == "JPEG"
+    assert resized.mime_type == "image/jpeg"
+
+
+def test_lazy_image(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes((Path(__file__).parent / "images" / "sample.png").read_bytes())
+
+    img = Image(path=path, mime_type="image/png")
+    assert img._data is None
+    assert len(img) == path.stat().st_size
+    assert img.pixels == 1500 * 1500
+    assert img._data is None
+    assert img.data == path.read_bytes()
+    assert img.digest == Image(data=path.read_bytes()).digest
+
+
+def test_image_view(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"not really an image")
+
+    for img in (Image(path=path), Image(data=path.read_bytes())):
+        assert bytes(img.view()) == b"not really an image"
+        with img.open() as f:
+            assert f.read() == b"not really an image"
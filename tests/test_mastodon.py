@@ -1,5 +1,13 @@
+import asyncio
 import configparser
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import httpx
+
+from polybot.image import Image
 from polybot.service import Mastodon
 
 
@@ -22,3 +30,269 @@ def test_instance_info():
     assert service.software == "mastodon"
     assert service.max_length == 500
     assert service.max_image_size == 16777216
+
+
+def test_post_async():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.url.path == "/api/v2/media":
+            return httpx.Response(200, json={"id": "m1"})
+        return httpx.Response(200, json={"id": "s1", "content": "Hello"})
+
+    config = configparser.ConfigParser()
+    service = Mastodon(config, True)
+    service.async_http = httpx.AsyncClient(
+        base_url="https://example.com", transport=httpx.MockTransport(handler)
+    )
+
+    image = Image(data=b"data", mime_type="image/png", description="Alt")
+    out = asyncio.run(service.do_post_async("Hello", [image], in_reply_to_id="r1"))
+    assert out["id"] == "s1"
+    assert [r.url.path for r in requests] == ["/api/v2/media", "/api/v1/statuses"]
+    assert json.loads(requests[1].content) == {
+        "status": "Hello",
+        "in_reply_to_id": "r1",
+        "media_ids": ["m1"],
+    }
+
+
+def test_media_processing(monkeypatch):
+    monkeypatch.setattr("polybot.service.MEDIA_POLL_DELAY", 0.01)
+    polls = {"m1": 2, "m2": 1}
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        if request.url.path == "/api/v2/media":
+            media_id = f"m{requests.count('/api/v2/media')}"
+            return httpx.Response(202, json={"id": media_id, "url": None})
+        if request.url.path.startswith("/api/v1/media/"):
+            media_id = request.url.path.split("/")[-1]
+            polls[media_id] -= 1
+            if polls[media_id]:
+                return httpx.Response(206, json={"id": media_id, "url": None})
+            return httpx.Response(200, json={"id": media_id, "url": "https://x/"})
+        assert polls == {"m1": 0, "m2": 0}
+        return httpx.Response(200, json={"id": "s1"})
+
+    service = Mastodon(configparser.ConfigParser(), True)
+    service.async_http = httpx.AsyncClient(
+        base_url="https://example.com", transport=httpx.MockTransport(handler)
+    )
+    images = [Image(data=b"data", mime_type="image/png") for _ in range(2)]
+    assert asyncio.run(service.do_post_async("Hello", images))["id"] == "s1"
+    assert requests[-1] == "/api/v1/statuses"
+
+    class MockClient:
+        ratelimit_remaining = 300
+        ratelimit_reset = 0
+
+        def __init__(self):
+            self.polls = 0
+
+        def media_post(self, f, mime_type, description, synchronous):
+            assert not synchronous
+            return {"id": "m1", "url": None}
+
+        def media(self, media_id):
+            self.polls += 1
+            return {"id": media_id, "url": "https://x/" if self.polls > 1 else None}
+
+        def status_post(self, status, in_reply_to_id, media_ids, idempotency_key):
+            assert [m["url"] for m in media_ids] == ["https://x/"]
+            assert idempotency_key
+            return {"id": "s1"}
+
+    service.mastodon = MockClient()
+    assert service.do_post("Hello", images[:1]) == {"id": "s1"}
+    assert service.mastodon.polls == 2
+
+
+class MockInstance:
+    """A mock Mastodon instance which supports conditional requests."""
+
+    def __init__(self):
+        self.requests = []
+        self.etag = '"v1"'
+        self.max_characters = 1000
+        self.reachable = True
+
+    def __call__(self, request):
+        self.requests.append(request.url.path)
+        if not self.reachable:
+            raise httpx.ConnectError("Connection refused", request=request)
+        if request.url.path == "/.well-known/nodeinfo":
+            return httpx.Response(
+                200,
+                json={
+                    "links": [
+                        {
+                            "rel": "http://nodeinfo.diaspora.software/ns/schema/2.0",
+                            "href": "https://example.com/nodeinfo/2.0",
+                        }
+                    ]
+                },
+            )
+        if request.url.path == "/nodeinfo/2.0":
+            return httpx.Response(200, json={"software": {"name": "mastodon"}})
+        if request.url.path == "/api/v1/instance":
+            if request.headers.get("If-None-Match") == self.etag:
+                return httpx.Response(304)
+            return httpx.Response(
+                200,
+                headers={"ETag": self.etag},
+                json={
+                    "configuration": {
+                        "statuses": {
+                            "max_characters": self.max_characters,
+                            "max_media_attachments": 6,
+                        },
+                        "media_attachments": {
+                            "image_size_limit": 1000000,
+                            "image_matrix_limit": 2000000,
+                            "supported_mime_types": ["image/png", "video/mp4"],
+                        },
+                    }
+                },
+            )
+        return httpx.Response(404)
+
+
+def mock_service(instance, cache_path):
+    config = configparser.ConfigParser()
+    config.add_section("mastodon")
+    config.set("mastodon", "base_url", "https://example.com")
+    service = Mastodon(config, False, cache_path=str(cache_path))
+    service.http = httpx.Client(transport=httpx.MockTransport(instance))
+    return service
+
+
+def test_instance_info_cache(tmp_path):
+    instance = MockInstance()
+    cache_path = tmp_path / "bot.mastodon.cache"
+
+    service = mock_service(instance, cache_path)
+    service.update_instance_info()
+    assert len(instance.requests) == 4
+    assert service.software == "mastodon"
+    assert service.max_length == 1000
+    assert service.max_image_size == 1000000
+    assert service.max_image_pixels == 2000000
+    assert service.max_image_count == 6
+    assert service.image_mime_types == ("image/png",)
+
+    # Within the TTL, no requests are made
+    service = mock_service(instance, cache_path)
+    service.update_instance_info()
+    assert len(instance.requests) == 4
+    assert service.max_length == 1000
+    assert service.image_mime_types == ("image/png",)
+
+    # After the TTL, the cached info is revalidated
+    service = mock_service(instance, cache_path)
+    service.config.set("mastodon", "instance_cache_ttl", "0")
+    service.update_instance_info()
+    assert instance.requests[4:] == ["/api/v1/instance"]
+    assert service.software == "mastodon"
+    assert service.max_length == 1000
+
+
+def test_instance_info_changed(tmp_path):
+    instance = MockInstance()
+    cache_path = tmp_path / "bot.mastodon.cache"
+    mock_service(instance, cache_path).update_instance_info()
+
+    # The new details are taken from the response to the conditional request
+    instance.etag = '"v2"'
+    instance.max_characters = 500
+    service = mock_service(instance, cache_path)
+    service.config.set("mastodon", "instance_cache_ttl", "0")
+    service.update_instance_info()
+    assert instance.requests[4:] == ["/api/v1/instance"]
+    assert service.software == "mastodon"
+    assert service.max_length == 500
+
+    service = mock_service(instance, cache_path)
+    service.config.set("mastodon", "instance_cache_ttl", "0")
+    service.update_instance_info()
+    assert instance.requests[5:] == ["/api/v1/instance"]
+    assert service.max_length == 500
+
+
+def test_instance_info_unreachable(tmp_path):
+    instance = MockInstance()
+    cache_path = tmp_path / "bot.mastodon.cache"
+    mock_service(instance, cache_path).update_instance_info()
+
+    # The stale details are used rather than failing
+    instance.reachable = False
+    service = mock_service(instance, cache_path)
+    service.config.set("mastodon", "instance_cache_ttl", "0")
+    service.update_instance_info()
+    assert instance.requests[4:] == ["/api/v1/instance"]
+    assert service.software == "mastodon"
+    assert service.max_length == 1000
+
+
+class SlowInstanceHandler(BaseHTTPRequestHandler):
+    """Serves a Mastodon instance with both v1 and v2 instance endpoints, slowly."""
+
+    delay = 0.3
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        base_url = f"http://127.0.0.1:{self.server.server_port}"
+        if self.path == "/.well-known/nodeinfo":
+            body = {
+                "links": [
+                    {
+                        "rel": "http://nodeinfo.diaspora.software/ns/schema/2.0",
+                        "href": base_url + "/nodeinfo/2.0",
+                    }
+                ]
+            }
+        elif self.path == "/nodeinfo/2.0":
+            body = {"software": {"name": "mastodon"}}
+        elif self.path == "/api/v1/instance":
+            body = {"configuration": {"statuses": {"max_characters": 500}}}
+        elif self.path == "/api/v2/instance":
+            body = {"configuration": {"statuses": {"max_characters": 2000}}}
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_instance_info_concurrent():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowInstanceHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        config = configparser.ConfigParser()
+        config.add_section("mastodon")
+        config.set("mastodon", "base_url", f"http://127.0.0.1:{server.server_port}")
+        service = Mastodon(config, False)
+
+        start = time.monotonic()
+        service.update_instance_info()
+        elapsed = time.monotonic() - start
+
+        assert service.software == "mastodon"
+        assert service.max_length == 2000
+        # The two chained nodeinfo requests take longest; fetched sequentially, all four
+        # requests would take at least 1.2s
+        assert elapsed < 4 * SlowInstanceHandler.delay
+    finally:
+        server.shutdown()
+        server.server_close()
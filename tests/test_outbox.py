@@ -0,0 +1,189 @@
+import threading
+import time
+
+import httpx
+
+from polybot import Bot
+from polybot.outbox import Outbox
+from polybot.service import PostError, Service
+
+
+class Recorder:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.delivered = []
+
+    def __call__(self, service, payload):
+        if self.failures:
+            self.failures -= 1
+            raise PostError("failed", transient=True)
+        self.delivered.append((service, payload))
+        return payload
+
+
+class QueueBot(Bot):
+    post_queue = True
+
+    def main(self):
+        pass
+
+
+class EchoService(Service):
+    def __init__(self, name, delay):
+        super().__init__(None, True)
+        self.name = name
+        self.delay = delay
+
+    def do_post(
+        self,
+        status,
+        images=[],
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        time.sleep(self.delay)
+        return (self.name, status, in_reply_to_id)
+
+
+def test_outbox_delivery(tmp_path):
+    deliver = Recorder(failures=2)
+    outbox = Outbox(str(tmp_path / "bot.queue"), deliver, retry_delay=0.01)
+    futures = [outbox.put("a", i) for i in range(3)]
+    outbox.start("a")
+    assert [f.result(timeout=2) for f in futures] == [0, 1, 2]
+    assert deliver.delivered == [("a", 0), ("a", 1), ("a", 2)]
+    assert outbox.pending() == 0
+    outbox.close()
+
+
+def test_outbox_give_up(tmp_path):
+    outbox = Outbox(
+        str(tmp_path / "bot.queue"), Recorder(failures=5), retry_delay=0, max_attempts=3
+    )
+    future = outbox.put("a", "hello")
+    outbox.start("a")
+    assert isinstance(future.exception(timeout=2), PostError)
+    assert outbox.pending() == 0
+    outbox.close()
+
+
+def test_outbox_permanent_error(tmp_path):
+    deliver = Recorder()
+
+    def fail(service, payload):
+        if payload == "bad":
+            raise PostError("rejected")
+        return deliver(service, payload)
+
+    outbox = Outbox(str(tmp_path / "bot.queue"), fail, retry_delay=10)
+    bad = outbox.put("a", "bad")
+    good = outbox.put("a", "good")
+    outbox.start("a")
+    assert isinstance(bad.exception(timeout=2), PostError)
+    assert good.result(timeout=2) == "good"
+    outbox.close()
+
+
+def test_outbox_close_during_delivery(tmp_path):
+    path = str(tmp_path / "bot.queue")
+    started = threading.Event()
+
+    def slow(service, payload):
+        started.set()
+        time.sleep(0.3)
+        return payload
+
+    outbox = Outbox(path, slow)
+    future = outbox.put("a", "hello")
+    outbox.start("a")
+    assert started.wait(2)
+    outbox.close()
+    assert future.result(timeout=0) == "hello"
+    assert Outbox(path, Recorder()).pending() == 0
+
+
+def test_outbox_persistence(tmp_path):
+    path = str(tmp_path / "bot.queue")
+    outbox = Outbox(path, Recorder())
+    outbox.put("a", "one")
+    outbox.put("b", "two")
+    outbox.close()
+
+    deliver = Recorder()
+    outbox = Outbox(path, deliver)
+    assert outbox.pending() == 2
+    assert outbox.pending("a") == 1
+    outbox.start("a")
+    outbox.start("b")
+    deadline = time.monotonic() + 2
+    while outbox.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(deliver.delivered) == [("a", "one"), ("b", "two")]
+    outbox.close()
+
+
+def test_queued_post(tmp_path):
+    bot = QueueBot("test_bot")
+    bot.prefix = str(tmp_path / "test_bot")
+    bot.services = [EchoService("a", 0.2), EchoService("b", 0)]
+    bot.open_outbox()
+
+    start = time.monotonic()
+    out = bot.post("Hello", in_reply_to_id={"a": 1, "b": 2})
+    assert time.monotonic() - start < 0.1
+    assert out["a"].result(timeout=2) == ("a", "Hello", 1)
+    assert out["b"].result(timeout=2) == ("b", "Hello", 2)
+    bot.outbox.close()
+
+
+def test_queued_post_not_repeated(tmp_path):
+    class FlakyService(Service):
+        name = "flaky"
+
+        def __init__(self):
+            super().__init__(None, True)
+            self.keys = []
+
+        def create_post(
+            self,
+            status,
+            media,
+            lat=None,
+            lon=None,
+            in_reply_to_id=None,
+            idempotency_key=None,
+        ):
+            self.keys.append(idempotency_key)
+            request = httpx.Request("POST", "https://example.com/")
+            response = httpx.Response(503, request=request)
+            raise httpx.HTTPStatusError("error", request=request, response=response)
+
+    svc = FlakyService()
+    outbox = Outbox(
+        str(tmp_path / "bot.queue"), lambda name, payload: svc.post(*payload)
+    )
+    # The post may have been created, so it's not delivered again
+    future = outbox.put("flaky", ("Hello", False, [], None, None, None, "key"))
+    outbox.start("flaky")
+    error = future.exception(timeout=2)
+    assert isinstance(error, PostError) and error.may_have_posted
+    assert svc.keys == ["key"]
+    outbox.close()
+
+    # Idempotent services reuse the queued key
+    svc = FlakyService()
+    svc.idempotent_posts = True
+    svc.retry_delay = 0.001
+    outbox = Outbox(
+        str(tmp_path / "bot2.queue"),
+        lambda name, payload: svc.post(*payload),
+        retry_delay=0.001,
+        max_attempts=2,
+    )
+    future = outbox.put("flaky", ("Hello", False, [], None, None, None, "key"))
+    outbox.start("flaky")
+    assert isinstance(future.exception(timeout=5), PostError)
+    assert svc.keys == ["key"] * 6
+    outbox.close()
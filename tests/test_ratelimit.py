@@ -0,0 +1,65 @@
+import configparser
+import time
+
+from polybot.ratelimit import RateLimiter, parse_reset
+from polybot.service import Service
+
+
+def test_token_bucket():
+    limiter = RateLimiter(rate=3600, burst=2)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    # Waiting posts are spaced out at the rate limit
+    assert 0.9 < limiter.reserve() <= 1
+    assert 1.9 < limiter.reserve() <= 2
+
+
+def test_unlimited():
+    limiter = RateLimiter()
+    assert all(limiter.reserve() == 0 for _ in range(100))
+
+
+def test_parse_reset():
+    now = 1_700_000_000.0
+    assert parse_reset("30", now) == now + 30
+    assert parse_reset("1700000100", now) == 1_700_000_100
+    assert parse_reset("2023-11-14T22:15:00.000Z", now) == 1_700_000_100
+    assert parse_reset("soon", now) is None
+    assert parse_reset(None, now) is None
+
+
+def test_update_from_headers():
+    reset = time.time() + 60
+    limiter = RateLimiter()
+    limiter.update_from_headers(
+        {"X-RateLimit-Remaining": "5", "X-RateLimit-Reset": "60"}
+    )
+    assert limiter.reserve() == 0
+
+    # Twitter
+    limiter.update_from_headers(
+        {"x-rate-limit-remaining": "0", "x-rate-limit-reset": str(int(reset))}
+    )
+    assert 58 < limiter.reserve() <= 60
+
+    # Bluesky
+    limiter = RateLimiter()
+    limiter.update_from_headers({"ratelimit-remaining": "0", "ratelimit-reset": "30"})
+    assert 29 < limiter.reserve() <= 30
+
+    limiter = RateLimiter()
+    limiter.update_from_headers({"Retry-After": "10"})
+    assert 9 < limiter.reserve() <= 10
+
+
+def test_service_config():
+    class TestService(Service):
+        name = "test"
+
+    config = configparser.ConfigParser()
+    assert TestService(config, False).rate_limiter.rate is None
+
+    config["test"] = {"rate_limit": "100", "rate_limit_burst": "5"}
+    limiter = TestService(config, False).rate_limiter
+    assert limiter.rate == 100
+    assert limiter.burst == 5
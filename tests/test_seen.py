@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from polybot import Bot
+from polybot.seen import SeenSet
+
+
+def test_seen_set():
+    seen = SeenSet()
+    assert "a" not in seen
+    assert seen.add("a")
+    assert not seen.add("a")
+    assert "a" in seen
+    assert seen.add(1)
+    assert "1" not in seen
+    assert 1 in seen
+    assert len(seen) == 2
+
+    seen.discard("a")
+    assert "a" not in seen
+    assert 1 in seen
+    assert len(seen) == 1
+
+    with pytest.raises(TypeError):
+        seen.add(1.5)
+
+
+def test_seen_set_grow():
+    seen = SeenSet()
+    for i in range(20000):
+        seen.add(f"https://example.com/{i}")
+    assert len(seen) == 20000
+    assert all(f"https://example.com/{i}" in seen for i in range(20000))
+    assert "https://example.com/20000" not in seen
+    assert seen.nbytes / len(seen) < 20
+
+    for i in range(0, 20000, 2):
+        seen.discard(f"https://example.com/{i}")
+    assert len(seen) == 10000
+    assert all(f"https://example.com/{i}" in seen for i in range(1, 20000, 2))
+    assert not any(f"https://example.com/{i}" in seen for i in range(0, 20000, 2))
+
+
+def test_seen_set_ttl(monkeypatch):
+    now = 1000000.0
+    monkeypatch.setattr("polybot.seen.time", lambda: now)
+    seen = SeenSet(ttl=60)
+    seen.add("a")
+    now += 30
+    seen.add("b")
+    assert "a" in seen
+
+    now += 40
+    assert "a" not in seen
+    assert "b" in seen
+    assert seen.add("a")
+
+    now += 61
+    seen.expire()
+    assert len(seen) == 0
+
+
+def test_seen_set_save(tmp_path):
+    path = str(tmp_path / "bot.seen")
+    with pytest.raises(OSError):
+        SeenSet.load(path)
+
+    seen = SeenSet()
+    for i in range(5000):
+        seen.add(i)
+    seen.save(path)
+    assert not seen.changed
+
+    loaded = SeenSet.load(path)
+    assert len(loaded) == 5000
+    assert all(i in loaded for i in range(5000))
+    assert 5000 not in loaded
+
+    loaded = SeenSet.load(path, ttl=60)
+    assert 1 in loaded
+
+    with open(path, "wb") as f:
+        f.write(b"not a seen set")
+    with pytest.raises(ValueError):
+        SeenSet.load(path)
+
+
+class SeenBot(Bot):
+    def main(self):
+        pass
+
+
+def test_bot_seen(tmp_path):
+    bot = SeenBot("test_bot")
+    bot.state_path = str(tmp_path / "test_bot.state")
+    bot.load_state()
+    bot.save_state()
+    assert not os.path.exists(bot.state_path + ".seen")
+
+    bot.seen.add("post-1")
+    bot.save_state()
+
+    bot = SeenBot("test_bot")
+    bot.state_path = str(tmp_path / "test_bot.state")
+    bot.load_state()
+    assert "post-1" in bot.seen
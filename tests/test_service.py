@@ -0,0 +1,219 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from polybot.image import Image
+from polybot.service import PostError, Service, is_transient, is_unsent
+
+
+def status_error(code):
+    request = httpx.Request("POST", "https://example.com/")
+    response = httpx.Response(code, request=request)
+    return httpx.HTTPStatusError("error", request=request, response=response)
+
+
+def test_is_transient():
+    assert is_transient(status_error(503))
+    assert is_transient(status_error(429))
+    assert not is_transient(status_error(422))
+    assert is_transient(httpx.ConnectTimeout("timeout"))
+    assert is_transient(ConnectionResetError())
+    assert not is_transient(ValueError())
+
+    assert PostError(status_error(502)).transient
+    assert not PostError("failed").transient
+    assert PostError("failed", transient=True).transient
+
+
+class StepService(Service):
+    name = "steps"
+    retry_delay = 0.001
+    idempotent_posts = True
+
+    def __init__(self, failures):
+        super().__init__(None, True)
+        # Exceptions to raise from successive create_post calls
+        self.failures = failures
+        self.uploads = 0
+        self.creates = 0
+        self.keys = set()
+
+    def upload_image(self, image):
+        self.uploads += 1
+        return self.uploads
+
+    def create_post(
+        self,
+        status,
+        media,
+        lat=None,
+        lon=None,
+        in_reply_to_id=None,
+        idempotency_key=None,
+    ):
+        self.creates += 1
+        self.keys.add(idempotency_key)
+        if self.failures:
+            raise self.failures.pop(0)
+        return (status, media)
+
+
+def test_retry_failed_step():
+    svc = StepService([status_error(503), httpx.ReadTimeout("timeout")])
+    image = Image(data=b"image", mime_type="image/png")
+    assert svc.do_post("Hello", [image, image]) == ("Hello", [1, 2])
+    assert svc.creates == 3
+    # Images aren't uploaded again when creating the post is retried
+    assert svc.uploads == 2
+    # Every attempt has the same idempotency key
+    assert len(svc.keys) == 1 and None not in svc.keys
+
+
+def test_is_unsent():
+    assert is_unsent(status_error(429))
+    assert is_unsent(httpx.ConnectError("refused"))
+    assert not is_unsent(httpx.ReadTimeout("timeout"))
+    assert not is_unsent(status_error(503))
+    try:
+        try:
+            raise httpx.ConnectError("refused")
+        except httpx.ConnectError as e:
+            raise RuntimeError("wrapped") from e
+    except RuntimeError as e:
+        assert is_unsent(PostError(e))
+
+
+def test_retry_not_idempotent():
+    svc = StepService([httpx.ConnectError("refused"), status_error(429)])
+    svc.idempotent_posts = False
+    assert svc.do_post("Hello") == ("Hello", [])
+    assert svc.creates == 3
+
+    # The post may have been created, so it's not retried
+    svc = StepService([httpx.ReadTimeout("timeout")])
+    svc.idempotent_posts = False
+    with pytest.raises(PostError) as e:
+        svc.do_post("Hello")
+    assert svc.creates == 1
+    # ...nor by the outbox
+    assert not e.value.transient
+    assert e.value.may_have_posted
+
+
+def test_permanent_error():
+    svc = StepService([status_error(422)])
+    with pytest.raises(PostError) as e:
+        svc.do_post("Hello")
+    assert not e.value.transient
+    assert svc.creates == 1
+
+
+def test_max_attempts():
+    svc = StepService([status_error(500)] * 5)
+    with pytest.raises(PostError):
+        svc.do_post("Hello")
+    assert svc.creates == svc.max_attempts
+
+
+def test_retry_deadline():
+    svc = StepService([status_error(500)] * 5)
+    svc.retry_delay = 10
+    svc.retry_deadline = 1
+    with pytest.raises(PostError):
+        svc.do_post("Hello")
+    assert svc.creates == 1
+
+
+class SlowUploadService(StepService):
+    def __init__(self):
+        super().__init__([])
+
+    def upload_image(self, image):
+        time.sleep(0.2)
+        return image.description
+
+
+def test_parallel_uploads():
+    svc = SlowUploadService()
+    images = [Image(data=b"image", description=str(i)) for i in range(4)]
+
+    start = time.monotonic()
+    assert svc.do_post("Hello", images) == ("Hello", ["0", "1", "2", "3"])
+    assert time.monotonic() - start < 0.4
+
+    start = time.monotonic()
+    assert asyncio.run(svc.upload_images_async(images)) == ["0", "1", "2", "3"]
+    assert time.monotonic() - start < 0.4
+
+
+def test_media_cache(tmp_path):
+    class CachingService(StepService):
+        media_cache_ttl = 60
+
+        def __init__(self):
+            Service.__init__(self, None, True, cache_path=str(tmp_path / "cache"))
+            self.failures = []
+            self.uploads = self.creates = 0
+            self.keys = set()
+
+    svc = CachingService()
+    image = Image(data=b"image", description="An image")
+    assert svc.do_post("Hello", [image]) == ("Hello", [1])
+    assert svc.do_post("Hello", [image]) == ("Hello", [1])
+    assert svc.uploads == 1
+
+    # The description is part of the key
+    relabelled = Image(data=b"image", description="Another image")
+    assert svc.do_post("Hello", [relabelled]) == ("Hello", [2])
+
+    # The cache persists, and entries expire
+    svc = CachingService()
+    assert svc.do_post("Hello", [image]) == ("Hello", [1])
+    assert svc.uploads == 0
+    for entry in svc.cache["media"].values():
+        entry["expires"] = 0
+    assert svc.do_post("Hello", [image]) == ("Hello", [1])
+    assert svc.uploads == 1
+
+
+def test_media_cache_failed_post(tmp_path):
+    class CachingService(StepService):
+        media_cache_ttl = 60
+
+        def __init__(self, failures):
+            super().__init__(failures)
+            self.cache_path = str(tmp_path / "cache")
+
+    image = Image(data=b"image")
+
+    # Images aren't cached unless the post is created
+    svc = CachingService([status_error(422)])
+    with pytest.raises(PostError):
+        svc.do_post("Hello", [image])
+    assert svc.do_post("Hello", [image]) == ("Hello", [2])
+    assert svc.uploads == 2
+
+    # If posting with cached images fails, they're uploaded again
+    svc.failures = [status_error(400)]
+    assert svc.do_post("Hello", [image]) == ("Hello", [3])
+    assert svc.do_post("Hello", [image]) == ("Hello", [3])
+    assert svc.uploads == 3
+
+    svc.failures = [status_error(400)]
+    assert asyncio.run(svc.upload_and_post_async("Hello", [image])) == ("Hello", [4])
+
+    # A post which may have been created isn't posted again
+    svc.failures = [status_error(503)]
+    svc.idempotent_posts = False
+    creates = svc.creates
+    with pytest.raises(PostError):
+        svc.do_post("Hello", [image])
+    assert svc.creates == creates + 1
+
+    # When it's posted again, the idempotency key is the same
+    svc.failures = [status_error(400)]
+    svc.keys = set()
+    svc.do_post("Hello", [image])
+    assert len(svc.keys) == 1
@@ -0,0 +1,318 @@
+import asyncio
+import os
+import pickle
+import threading
+import time
+
+import pytest
+
+from polybot import AsyncBot, Bot
+from polybot.state import (
+    PickleBackend,
+    SQLiteBackend,
+    StateCodec,
+    StateDict,
+    StateWriter,
+)
+
+
+def test_pickle_backend(tmp_path):
+    path = str(tmp_path / "bot.state")
+    backend = PickleBackend(path)
+    with pytest.raises(OSError):
+        backend.load()
+
+    backend.save({"a": 1})
+    assert backend.load() == {"a": 1}
+    assert os.listdir(tmp_path) == ["bot.state"]
+
+
+def test_state_dict_changes():
+    state = StateDict({"count": 1, "seen": {1, 2}, "gone": "x"})
+    assert state.changes() == ({}, set())
+
+    state["count"] += 1
+    state["seen"].add(3)
+    del state["gone"]
+    assert state.changes() == ({"count": 2, "seen": {1, 2, 3}}, {"gone"})
+    assert state.changes() == ({}, set())
+
+    # Reading immutable values doesn't mark them as changed
+    assert state["count"] == 2
+    assert state.changes() == ({}, set())
+
+    with pytest.raises(TypeError):
+        state[1] = "one"
+
+
+def test_sqlite_backend(tmp_path):
+    path = str(tmp_path / "bot.state")
+    backend = SQLiteBackend(path)
+    state = backend.load()
+    assert state == {}
+
+    state["count"] = 1
+    state["seen"] = {1, 2}
+    state["gone"] = "x"
+    backend.save(state)
+    state["seen"].add(3)
+    del state["gone"]
+    backend.save(state)
+    backend.close()
+
+    assert SQLiteBackend(path).load() == {"count": 1, "seen": {1, 2, 3}}
+
+    # Replacing the state with a plain dict rewrites it
+    backend = SQLiteBackend(path)
+    backend.save({"new": True})
+    assert SQLiteBackend(path).load() == {"new": True}
+
+
+def test_sqlite_merge(tmp_path):
+    path = str(tmp_path / "bot.state")
+    backend = SQLiteBackend(path)
+    state = backend.load()
+    state["a"] = 1
+    state["b"] = 1
+    first = backend.snapshot(state)
+    del state["a"]
+    state["b"] = 2
+    state["c"] = 3
+    backend.write(backend.merge(first, backend.snapshot(state)))
+    backend.close()
+
+    assert SQLiteBackend(path).load() == {"b": 2, "c": 3}
+
+
+def test_sqlite_import(tmp_path):
+    path = str(tmp_path / "bot.state")
+    with open(path, "wb") as f:
+        pickle.dump({"a": 1}, f)
+    assert SQLiteBackend(path).load() == {"a": 1}
+    os.unlink(path)
+    assert SQLiteBackend(path).load() == {"a": 1}
+
+
+class StateBot(Bot):
+    state_backend = "sqlite"
+
+    def main(self):
+        pass
+
+
+def test_bot_state(tmp_path):
+    bot = StateBot("test_bot")
+    bot.state_path = str(tmp_path / "test_bot.state")
+    bot.load_state()
+    bot.state["last"] = 123
+    bot.save_state()
+
+    bot = StateBot("test_bot")
+    bot.state_path = str(tmp_path / "test_bot.state")
+    bot.load_state()
+    assert bot.state == {"last": 123}
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_autosave_interval():
+    saves = []
+    writer = StateWriter(lambda: 1, saves.append, interval=0.05)
+    writer.start()
+    assert wait_for(lambda: len(saves) >= 2)
+    writer.stop()
+
+
+def test_autosave_changes(monkeypatch):
+    monkeypatch.setattr("polybot.state.CHANGE_POLL_INTERVAL", 0.01)
+    state = StateDict()
+    saves = []
+    writer = StateWriter(
+        lambda: dict(state),
+        saves.append,
+        max_changes=3,
+        count_changes=lambda: state.mutations,
+    )
+    writer.start()
+    state["a"] = 1
+    state["b"] = 2
+    time.sleep(0.05)
+    assert saves == []
+    state["c"] = 3
+    assert wait_for(lambda: saves == [{"a": 1, "b": 2, "c": 3}])
+    writer.stop()
+
+
+def test_autosave_retry():
+    attempts = []
+    saves = []
+
+    def snapshot():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("dictionary changed size during iteration")
+        return len(attempts)
+
+    writer = StateWriter(snapshot, saves.append, interval=0)
+    assert writer._save()
+    assert len(attempts) == 3
+    assert saves == [3]
+
+
+def test_save_failure_retried(monkeypatch):
+    monkeypatch.setattr("polybot.state.SAVE_RETRY_DELAY", 0.05)
+    snapshots = iter(range(10))
+    saves = []
+
+    def write(snapshot):
+        if not saves:
+            saves.append(None)
+            raise OSError("No space left on device")
+        saves.append(snapshot)
+
+    writer = StateWriter(lambda: next(snapshots), write, lambda old, new: old + new)
+    writer.start()
+    writer.request()
+    assert wait_for(lambda: len(saves) == 1)
+    writer.request()
+    # The failed snapshot is written along with the newer one
+    assert wait_for(lambda: saves == [None, 1])
+    writer.stop()
+
+
+def test_autosave_failure_still_due(monkeypatch):
+    monkeypatch.setattr("polybot.state.CHANGE_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr("polybot.state.SAVE_RETRY_DELAY", 0.05)
+    state = StateDict()
+    saves = []
+
+    def write(snapshot):
+        saves.append(snapshot)
+        if len(saves) == 1:
+            raise OSError("No space left on device")
+
+    writer = StateWriter(
+        lambda: dict(state),
+        write,
+        max_changes=1,
+        count_changes=lambda: state.mutations,
+    )
+    writer.start()
+    state["a"] = 1
+    # The changes weren't saved, so it's tried again without any more being made
+    assert wait_for(lambda: len(saves) == 2)
+    writer.stop()
+
+
+def test_async_background_snapshot():
+    threads = []
+
+    class SnapshotBot(AsyncBot):
+        def snapshot_state(self):
+            threads.append(threading.current_thread())
+            return super().snapshot_state()
+
+    async def run():
+        bot = SnapshotBot("test_bot")
+        bot.state_path = "test_bot.state"
+        bot._loop = asyncio.get_running_loop()
+        bot.state["last"] = 123
+        return await asyncio.to_thread(bot.background_snapshot_state)
+
+    assert pickle.loads(asyncio.run(run())) == {"last": 123}
+    assert threads == [threading.main_thread()]
+
+
+def test_flush_after_pending():
+    snapshots = iter(["a", "b"])
+    saves = []
+    writer = StateWriter(lambda: next(snapshots), saves.append, lambda o, n: o + n)
+    writer.request()
+    writer.flush("c")
+    assert saves == ["ac"]
+    # Nothing is left for the writer thread to write
+    assert writer._take() == (False, None)
+
+
+@pytest.mark.parametrize("name", ["pickle", "json", "pickle+gzip", "json+lzma"])
+def test_state_codec(name):
+    codec = StateCodec(name)
+    state = {"last": 123, "seen": ["a", "b"]}
+    assert codec.loads(codec.dumps(state)) == state
+
+
+def test_state_codec_fallback(tmp_path):
+    path = str(tmp_path / "bot.state")
+    PickleBackend(path).save({"seen": {1, 2}})
+    backend = PickleBackend(path, StateCodec("json+gzip"))
+    assert backend.load() == {"seen": {1, 2}}
+
+    backend.save({"seen": [1, 2]})
+    with open(path, "rb") as f:
+        assert f.read(2) == b"\x1f\x8b"
+    assert PickleBackend(path, StateCodec("json")).load() == {"seen": [1, 2]}
+
+    with pytest.raises(ValueError):
+        StateCodec("yaml")
+
+
+def test_save_request():
+    saving = threading.Event()
+    release = threading.Event()
+    saves = []
+    snapshots = iter(range(10))
+
+    def write(snapshot):
+        saves.append(snapshot)
+        saving.set()
+        release.wait(2)
+
+    writer = StateWriter(lambda: next(snapshots), write)
+    writer.start()
+    writer.request()
+    assert saving.wait(2)
+    # Requests made while a save is in progress are combined into one more save, of the
+    # latest snapshot
+    for _ in range(3):
+        writer.request()
+    release.set()
+    assert wait_for(lambda: len(saves) == 2)
+    time.sleep(0.05)
+    assert saves == [0, 3]
+    writer.stop()
+
+
+def test_bot_request_save(tmp_path):
+    bot = StateBot("test_bot")
+    bot.state_backend = "pickle"
+    bot.state_path = str(tmp_path / "test_bot.state")
+    bot.load_state()
+    bot.start_autosave()
+    bot.state["last"] = 123
+    bot.request_save()
+    # The state is saved as it was when the save was requested
+    bot.state["last"] = 456
+    assert wait_for(lambda: os.path.exists(bot.state_path))
+    bot.stop_autosave()
+
+    bot = StateBot("test_bot")
+    bot.state_backend = "pickle"
+    bot.state_path = str(tmp_path / "test_bot.state")
+    bot.load_state()
+    assert bot.state == {"last": 123}
+
+
+def test_autosave_changes_warning(tmp_path, caplog):
+    bot = StateBot("test_bot")
+    bot.state_backend = "pickle"
+    bot.autosave_changes = 10
+    bot.state_path = str(tmp_path / "test_bot.state")
+    bot.load_state()
+    bot.start_autosave()
+    bot.stop_autosave()
+    assert "autosave_changes has no effect" in caplog.text